@@ -110,6 +110,9 @@ def initialize_client():
         
         # Run initialization in the client's event loop
         run_async_in_client_loop(client_instance.initialize(config))
+
+        # Announce the task updates applied in the background after a response
+        client_instance.task_manager.on_update = emit_task_updated
         
         return jsonify({
             'status': 'success',
@@ -393,6 +396,33 @@ def get_memory_details():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def get_task_update_info(task_id):
+    """Task fields sent to the browser after a chat response or a background task update"""
+    task_manager = client_instance.task_manager
+    if not task_id or task_id not in task_manager.tasks:
+        return None
+
+    task = task_manager.tasks[task_id]
+    return {
+        'id': task_id,
+        'target': task.target,
+        'plan': task.plan,
+        'progress': task.progress,
+        'logs': [log.to_dict() for log in task.logs],
+        'is_working': task_id == task_manager.working_task,
+        'is_updating': task_manager.is_updating(task_id),
+        'logs_count': len(task.logs),
+        'files_count': sum(len(log.files) for log in task.logs)
+    }
+
+def emit_task_updated(task_id):
+    """Emit the state of a task once its background update is applied"""
+    socketio.emit('task_updated', {
+        'task_id': task_id,
+        'updated_task': get_task_update_info(task_id),
+        'timestamp': get_datetime_stamp()
+    })
+
 @app.route('/api/chat', methods=['POST'])
 def process_chat():
     """Process a chat query"""
@@ -406,28 +436,20 @@ def process_chat():
         if not query.strip():
             return jsonify({'error': 'Query cannot be empty'}), 400
         
-        response = run_async_in_client_loop(client_instance.process_query(query))
+        # Forward partial response text to the browser while it is being generated
+        def emit_delta(delta, iteration):
+            socketio.emit('chat_delta', {
+                'query': query,
+                'delta': delta,
+                'iteration': iteration,
+                'timestamp': get_datetime_stamp()
+            })
+
+        on_delta = emit_delta if data.get('stream', True) else None
+        response = run_async_in_client_loop(client_instance.process_query(query, on_delta=on_delta))
         
-        # Get updated task information
-        working_task_id = client_instance.task_manager.working_task
-        updated_task = None
-        if working_task_id and working_task_id in client_instance.task_manager.tasks:
-            task = client_instance.task_manager.tasks[working_task_id]
-            logs_data = []
-            for log in task.logs:
-                log_dict = log.to_dict()
-                logs_data.append(log_dict)
-            
-            updated_task = {
-                'id': working_task_id,
-                'target': task.target,
-                'plan': task.plan,
-                'progress': task.progress,
-                'logs': logs_data,
-                'is_working': True,
-                'logs_count': len(task.logs),
-                'files_count': sum(len(log.files) for log in task.logs)
-            }
+        # Get updated task information, the task update itself may still be running in the background
+        updated_task = get_task_update_info(client_instance.task_manager.working_task)
         
         # Emit real-time update via WebSocket
         socketio.emit('chat_response', {
@@ -1,4 +1,4 @@
-import os, sys, asyncio, json
+import os, sys, asyncio, json, functools
 import argparse, logging
 from typing import Optional, Dict, List, Tuple, Any
 
@@ -6,37 +6,93 @@ from manager import MCPServerManager, collect_mcp_server_configs
 from memory import *
 from task import *
 from provider import *
+from prompt import *
 from utils import *
 
+REACT_INSTRUCTIONS_TEMPLATE = '''
+You are an AI assistant, which is good at answer user's query from the conversations, based on the memory status and task status. In generating the response, you will consider to answer with four parts: 
+1. Think: analyze the context and think about what to do next.
+2. Text: the text response to the user's query.
+3. Memory Operation: if you need to perform a memory operation, return the operation name and parameters. Make sure a memroy operation is really necessary and not redundant and not repetitive. 
+4. Tool: if you need to use a tool, return the tool name and parameters. Make sure a memroy operation is really necessary and not redundant and not repetitive. 
+
+Furthermore, you have to explicitly indicate if you have finished the generation of response, or need to perform more steps or stop and wait for user's next query. This is important if you need multiple steps to answer current query well. Pay attentsion to following rules: 
+1. if you are not sure what to do next, you should leave the decision to the user. 
+2. if you need to get user's feedback, then don't call 'mem_op' or 'tool', just send text to ask user for more information, and set 'finished' to 'true'. 
+3. if you have an answer that is ready to send, then don't call 'mem_op' or 'tool', just send text to user, and set 'finished' to 'true'. 
+4. MAKE SURE don't set 'finished' to true, if you are still working on preparing the final response.
+
+{output_format}
+- **Do not** generate redundant content other than the result in JSON format.
+- The JSON must include the following keys and values accordingly :
+    - 'text': A JSON String for the text response to the user's query.
+    - 'think': A JSON String for the description of the thinking process to response to the user's query.
+    - 'mem_op': ONlY USED when you need to perform a memory operation (from the available memory operations), the value is a dictionary with the operation name and parameters: 
+        - 'name': The name of the memory operation.
+        - 'args': A dictionary of arguments for the operation.
+    - 'tool': ONLY USED when you need to use tools (from the available tools), the value is a list of tool calls, each a dictionary with the tool name and parameters. Calls in the same list are run at the same time, so put several independent calls together instead of one per step:
+        - 'name': The name of the tool to use.
+        - 'args': A dictionary of arguments for the tool.
+    - 'finished': A JSON bool value indicating if your actions are finished, set 'true' to stop processing and send the final response to the user; set 'false' to continue for more actions to complete the final answer. When you used a tool or you need more steps to collect information to complete the response, you should set 'finished' to 'false'. Note that
+        - If you need to perform more thinking or collect relevant data via tool calling, make sure to set 'finished' to 'false'. 
+        - If you need the user to provider more information to continue the processing, make sure to set 'finished' to 'true'. 
+'''
+
+# How the answer is delimited: fenced in free text, or bare JSON when the provider is made to follow
+# the output schema (JSON mode, a schema or a forced tool call)
+FENCED_OUTPUT_FORMAT = """The result should be formatted in **JSON** dictionary and enclosed in **triple backticks (` ``` ` )**  without labels like 'json', 'css', or 'data'.
+- **Do not** use triple backticks anywhere else in your answer."""
+STRUCTURED_OUTPUT_FORMAT = "The result should be formatted in **JSON** dictionary, without any labels or backticks around it."
+
+REACT_INSTRUCTIONS = REACT_INSTRUCTIONS_TEMPLATE.format(output_format = FENCED_OUTPUT_FORMAT)
+STRUCTURED_REACT_INSTRUCTIONS = REACT_INSTRUCTIONS_TEMPLATE.format(output_format = STRUCTURED_OUTPUT_FORMAT)
+
 class Client:
     """Pulsar Agent client with multi-server support and configurable LLM providers"""
     
     def __init__(self) :
         self.provider, self.memory = None, None
+        self.router = ProviderRouter()
         self.task_manager = TaskManager(self)
         self.server_manager = MCPServerManager()
+        self.compactor = ConversationCompactor()
+        self.context_gatherer = ContextGatherer()
+        self.section_cache = SectionCache()
         self.messages = []
+        self.last_prompt_bytes = b""
+        self.prompt_stats = {"turns" : 0, "prompt_bytes" : 0, "prefix_stable_bytes" : 0, "total_prompt_bytes" : 0, "total_prefix_stable_bytes" : 0}
+        self.prompt_sections, self.prompt_budget_stats = {}, {}
+        # Tools gathered for the last prompt, also used for its output schema and to check the calls in its answer
+        self.prompt_tools = {}
     
     async def initialize(self, configs: str):
         """Initialize the client with server configurations"""
         self.configs = configs or {}
 
-        provider_config = self.configs.get("provider", {})
-        provider_name = provider_config.get("name", None)
-        provider_cls = get_provider(provider_name) 
-
-        if provider_cls is not None : 
-            self.provider = provider_cls(provider_config)
-            add_log(f"Using provider: {provider_name}")
-        else:
-            add_log(f"Unknown provider: {provider_name}", label = "error")
+        self.router = ProviderRouter(self.configs)
+        self.provider = self.router.get_provider("react")
 
+        self.server_manager = MCPServerManager(self.configs.get("mcp", {}))
         mcp_severs_configs = collect_mcp_server_configs()
         await self.server_manager.load_servers_config(mcp_severs_configs)
         await self.server_manager.connect_all_servers()
 
         self.task_manager.load_config(self.configs.get("task", {}))
         self.memory = Memory(self, self.configs.get("memory", {}))
+        self.compactor = ConversationCompactor(self.router.get_provider("history_summary"), self.configs.get("compaction", {}))
+        self.context_gatherer = ContextGatherer(self.configs.get("context_sources", {}))
+        self.add_context_sources()
+        self.section_cache = SectionCache()
+
+    def add_context_sources(self) -> None :
+        """Register the default context sources, more can be added with context_gatherer.add_source"""
+        gatherer = self.context_gatherer
+        gatherer.add_source("common_sense", lambda query : self.get_common_sense_context(), "Common Sense Information", shared = True)
+        gatherer.add_source("static_memory", lambda query : self.memory.get_static_context(), "Static Memory", shared = True)
+        gatherer.add_source("static_task", lambda query : self.task_manager.get_static_context(), "Static Task", shared = True)
+        gatherer.add_source("dynamic_memory", self.memory.get_dynamic_context, "Dynamic Memory")
+        gatherer.add_source("dynamic_task", self.task_manager.get_dynamic_context, "Dynamic Task")
+        gatherer.add_source("tools", lambda query : self.server_manager.get_tools(), default = {}, shared = True)
 
     async def get_config_info(self) :
         operations = await self.memory.get_operations()
@@ -44,6 +100,18 @@ class Client:
     
         info = {
             "provider" : self.configs.get("provider", {}),
+            "routing" : self.router.get_routes_info(),
+            "llm_cache" : self.provider.cache.get_stats() if self.provider is not None else {},
+            "llm_scheduler" : self.provider.get_scheduler().get_stats() if self.provider is not None else {},
+            "prompt_prefix" : self.get_prompt_stats(),
+            "prompt_sections" : self.prompt_sections,
+            "prompt_budget" : self.prompt_budget_stats,
+            "llm_usage" : usage_counters.get_stats(),
+            "llm_metrics" : self.provider.get_metrics() if self.provider is not None else {},
+            "context_sources" : self.context_gatherer.get_stats(),
+            "section_cache" : self.section_cache.get_stats(),
+            "tool_cache" : self.server_manager.get_cache_stats(),
+            "tool_pools" : self.server_manager.get_pool_stats(),
             "memory_operations_num" : len(operations),
             "memory_operations" : [
                 {
@@ -61,15 +129,27 @@ class Client:
         }
         return info
     
-    async def react(self, query, tools : List = None) -> Tuple[Dict, bool] :
+    async def react(self, query, tools : List = None, on_delta = None) -> Tuple[Dict, bool] :
         response = {"content" : []}
-        # Convert messages to a single prompt
-        prompt = await self._context_to_prompt(query, tools)
-        add_log(f"Prompt: {prompt}", label="log", print = False)
-
-        text_response = await self.provider.generate_response(prompt)
+        # Convert messages to role-tagged chat messages, or to a single prompt
+        if self.configs.get("chat_messages", True) :
+            prompt = await self._context_to_messages(query, tools)
+        else :
+            prompt = await self._context_to_prompt(query, tools)
+        add_log(f"Prompt: {flatten_prompt(prompt)}", label="log", print = False)
+        self._record_prompt_stability(prompt)
+
+        if on_delta is not None :
+            text_response = await self._stream_text_response(prompt, on_delta)
+        else :
+            text_response = await self.provider.generate_hedged_response(prompt, priority = PRIORITY_INTERACTIVE)
         add_log(f"Text response: {text_response}", label = "log", print = False)
 
+        if not text_response :
+            add_log("No response from the LLM provider.", label = "error")
+            response["content"].append({"type": "text", "text": "Sorry, the LLM provider did not respond. Please try again later."})
+            return response, True
+
         dict_response = self._extract_output(text_response)
         add_log(f"Dict response: {dict_response}", label = "log", print = False)
 
@@ -90,104 +170,239 @@ class Client:
                     response["content"].append(op_call)
 
         if "tool" in dict_response.keys() :  
-            name = dict_response["tool"].get("name", None)
-            args = dict_response["tool"].get("args", {})
-            if name is not None and len(name.strip()) > 0 :
-                tool_call = {"type": "tool", "name" : name, "args": {}}
-                tools = await self.server_manager.get_tools()
-                if name in tools.keys() :
-                    for key, value in args.items() :
-                        if key in tools[name]["input_schema"]["properties"].keys() :
-                            tool_call["args"][key] = value
-                    response["content"].append(tool_call)
+            # Calls are checked against the tools the prompt listed, without waiting for the tool list again
+            all_tools = self.prompt_tools
+            for call in dict_response["tool"] :
+                name = call.get("name", None)
+                args = call.get("args", {})
+                if isinstance(name, str) and len(name.strip()) > 0 and isinstance(args, Dict) :
+                    tool_call = {"type": "tool", "name" : name, "args": {}}
+                    if name in all_tools.keys() :
+                        for key, value in args.items() :
+                            if key in all_tools[name]["input_schema"].get("properties", {}).keys() :
+                                tool_call["args"][key] = value
+                        response["content"].append(tool_call)
 
         add_log(f"Response: {response}", label = "log", print = False)
         return response, dict_response.get("finished", True)
 
-    async def _context_to_prompt(self, query, tools : List = None) -> str:
-        """Convert message format to prompt string"""
-        prompt_parts = ['''
-You are an AI assistant, which is good at answer user's query from the conversations, based on the memory status and task status. In generating the response, you will consider to answer with four parts: 
-1. Think: analyze the context and think about what to do next.
-2. Text: the text response to the user's query.
-3. Memory Operation: if you need to perform a memory operation, return the operation name and parameters. Make sure a memroy operation is really necessary and not redundant and not repetitive. 
-4. Tool: if you need to use a tool, return the tool name and parameters. Make sure a memroy operation is really necessary and not redundant and not repetitive. 
+    async def _stream_text_response(self, prompt, on_delta) -> str :
+        """Stream the provider response, forwarding deltas of its 'text' field to 'on_delta'"""
+        text_response, streamed_text = "", ""
+        async for delta in self.provider.stream_hedged_response(prompt, priority = PRIORITY_INTERACTIVE) :
+            text_response += delta
+            partial_text = extract_partial_json_string(text_response, "text")
+            if partial_text is not None and len(partial_text) > len(streamed_text) :
+                on_delta(partial_text[len(streamed_text):])
+                streamed_text = partial_text
+        return text_response
+
+    async def _get_context_sections(self, query, tools : List = None) -> Tuple[Dict[str, str], List[Dict]] :
+        """
+        Collect the titled context sections and the conversation history shared by the text and chat
+        prompts, fitted into the prompt token budget.
+        """
+        # All sources are fetched at once, so this takes as long as the slowest of them
+        texts = await self.context_gatherer.gather(query)
+        all_tools = texts.pop("tools", {})
+        self.prompt_tools = all_tools
+        for name, text in texts.items() :
+            add_log(f"Get {name}_text: {text}", label="log", print = False)
+
+        # The tool list is only rendered again when the MCP servers change
+        tools_version = (self.server_manager.version, tuple(all_tools.keys()), tuple(tools) if isinstance(tools, List) else None)
+        tool_items, compact_tool_items = await self.section_cache.get("tools", tools_version, lambda : self._render_tools(all_tools, tools))
+
+        # Instructions are never cut; tools are listed without schemas before being dropped,
+        # and the history keeps its latest messages, at least the current query
+        builder = PromptBuilder(self.configs.get("prompt_budget", {}))
+        builder.add_section("instructions", [self._get_instructions()], priority = 0, fixed = True)
+        builder.add_section("common_sense", [texts["common_sense"]], priority = 1)
+        builder.add_section("tools", tool_items, priority = 2, compact_items = compact_tool_items)
+        builder.add_section("history", self.compactor.get_history(self.messages), priority = 2, keep = "tail", min_items = 1, to_text = lambda msg : msg["content"])
+        builder.add_section("static_task", [texts["static_task"]], priority = 3)
+        builder.add_section("dynamic_task", [texts["dynamic_task"]], priority = 3)
+        builder.add_section("static_memory", [texts["static_memory"]], priority = 4)
+        builder.add_section("dynamic_memory", [texts["dynamic_memory"]], priority = 4)
+        for name, text in texts.items() :
+            if name not in builder.get_names() :
+                builder.add_section(name, [str(text)], priority = 5)
+        fitted = builder.build()
+        self.prompt_budget_stats = builder.get_stats()
+
+        sections = {}
+        for name, title in self.context_gatherer.get_titles().items() :
+            text = "\n".join(fitted[name])
+            if len(text) > 0 :
+                sections[name] = f"\n## {title}:\n{text}"
+        if len(all_tools) > 0 :
+            sections["tools"] = "\n".join(["\n## Available Tools:"] + fitted["tools"])
 
-Furthermore, you have to explicitly indicate if you have finished the generation of response, or need to perform more steps or stop and wait for user's next query. This is important if you need multiple steps to answer current query well. Pay attentsion to following rules: 
-1. if you are not sure what to do next, you should leave the decision to the user. 
-2. if you need to get user's feedback, then don't call 'mem_op' or 'tool', just send text to ask user for more information, and set 'finished' to 'true'. 
-3. if you have an answer that is ready to send, then don't call 'mem_op' or 'tool', just send text to user, and set 'finished' to 'true'. 
-4. MAKE SURE don't set 'finished' to true, if you are still working on preparing the final response.
+        history = list(fitted["history"])
+        if builder.get_omitted("history") > 0 :
+            history.insert(0, {"role" : "user", "content" : f"[{builder.get_omitted('history')} earlier messages omitted]"})
 
-The result should be formatted in **JSON** dictionary and enclosed in **triple backticks (` ``` ` )**  without labels like 'json', 'css', or 'data'.
-- **Do not** generate redundant content other than the result in JSON format.
-- **Do not** use triple backticks anywhere else in your answer.
-- The JSON must include the following keys and values accordingly :
-    - 'text': A JSON String for the text response to the user's query.
-    - 'think': A JSON String for the description of the thinking process to response to the user's query.
-    - 'mem_op': ONlY USED when you need to perform a memory operation (from the available memory operations), the value is a dictionary with the operation name and parameters: 
-        - 'name': The name of the memory operation.
-        - 'args': A dictionary of arguments for the operation.
-    - 'tool': ONLY USED when you need to use a tool (from the available tools), the value is a dictionary with the tool name and parameters:
-        - 'name': The name of the tool to use.
-        - 'args': A dictionary of arguments for the tool.
-    - 'finished': A JSON bool value indicating if your actions are finished, set 'true' to stop processing and send the final response to the user; set 'false' to continue for more actions to complete the final answer. When you used a tool or you need more steps to collect information to complete the response, you should set 'finished' to 'false'. Note that
-        - If you need to perform more thinking or collect relevant data via tool calling, make sure to set 'finished' to 'false'. 
-        - If you need the user to provider more information to continue the processing, make sure to set 'finished' to 'true'. 
-''']
-
-        common_sense_text = await self.get_common_sense_context()
-        add_log(f"Get common_sense_text: {common_sense_text}", label="log", print = False)
-        if len(common_sense_text) > 0 : 
-            prompt_parts.append(f"\n## Common Sense Information:\n{common_sense_text}")
-
-        static_memory_text = await self.memory.get_static_context()
-        add_log(f"Get static_memory_text: {static_memory_text}", label="log", print = False)
-        if len(static_memory_text) > 0 : 
-            prompt_parts.append(f"\n## Static Memory:\n{static_memory_text}")
-
-        # Fix: Use task_manager instead of task
-        static_task_text = await self.task_manager.get_static_context()
-        add_log(f"Get static_task_text: {static_task_text}", label="log", print = False)
-        if len(static_task_text) > 0 : 
-            prompt_parts.append(f"\n## Static Task:\n{static_task_text}")
-        
-        dynamic_memory_text = await self.memory.get_dynamic_context(query)
-        add_log(f"Get dynamic_memory_text: {dynamic_memory_text}", label="log", print = False)
-        if len(dynamic_memory_text) > 0 : 
-            prompt_parts.append(f"\n## Dynamic Memory:\n{dynamic_memory_text}")
-
-        # Fix: Use task_manager instead of task
-        dynamic_task_text = await self.task_manager.get_dynamic_context(query)
-        add_log(f"Get dynamic_task_text: {dynamic_task_text}", label="log", print = False)
-        if len(dynamic_task_text) > 0 : 
-            prompt_parts.append(f"\n## Dynamic Task:\n{dynamic_task_text}")
-            
-        # Get all available tools
-        all_tools = await self.server_manager.get_tools()
+        self.prompt_sections = self._get_section_sizes(sections, history)
+        add_log(f"Prompt section sizes: {self.prompt_sections}", label = "log", print = False)
+        return sections, history
+
+    def _render_tools(self, all_tools : Dict[str, Any], tools : List = None) -> Tuple[List[str], List[str]] :
+        """Tool list items with and without their input schemas"""
         # Format tools for LLM (remove server info for cleaner interface)
-        if len(all_tools) > 0 :
-            prompt_parts.append("\n## Available Tools:")
-            for tool in all_tools.values() :
-                if isinstance(tools, List) and tool["name"] not in tools : 
-                    continue
-                prompt_parts.append(f"- {tool['name']}: '{tool['description']}")
-                prompt_parts.append(f"  Input schema: {json.dumps(tool['input_schema'])}")
+        tool_items, compact_tool_items = [], []
+        for tool in all_tools.values() :
+            if isinstance(tools, List) and tool["name"] not in tools : 
+                continue
+            tool_items.append(f"- {tool['name']}: '{tool['description']}\n  Input schema: {json.dumps(tool['input_schema'])}")
+            compact_tool_items.append(f"- {tool['name']}: '{tool['description']}")
+        return tool_items, compact_tool_items
+
+    def _get_instructions(self) -> str :
+        """The agent instructions, which ask for a fenced JSON answer unless the provider is made to follow its schema"""
+        # Providers that do not enforce the schema may still wrap the JSON in prose, which only a fence lets us find
+        if self.configs.get("chat_messages", True) and self.configs.get("structured_output", True) and self.provider.supports_structured_output() :
+            return STRUCTURED_REACT_INSTRUCTIONS
+        return REACT_INSTRUCTIONS
+
+    def _get_section_sizes(self, sections : Dict[str, str], history : List[Dict]) -> Dict[str, int] :
+        """Size in characters of each part of the prompt, to see which part makes it grow"""
+        groups = {
+            "instructions" : [self._get_instructions()],
+            "tools" : [sections.get("tools", "")],
+            "memory" : [sections.get("static_memory", ""), sections.get("dynamic_memory", "")],
+            "task" : [sections.get("static_task", ""), sections.get("dynamic_task", "")],
+            "common_sense" : [sections.get("common_sense", "")],
+            "history" : [msg["content"] for msg in history],
+        }
+        # Sections of context sources added beside the default ones
+        grouped = ["tools", "static_memory", "dynamic_memory", "static_task", "dynamic_task", "common_sense"]
+        groups.update({name : [text] for name, text in sections.items() if name not in grouped})
+        return {name : sum(len(text) for text in texts) for name, texts in groups.items()}
+
+    def _get_dynamic_section_names(self, sections : Dict[str, str]) -> List[str] :
+        """Sections that change from turn to turn, put after the cacheable prefix"""
+        return [name for name in sections if name not in ["tools", "static_memory", "static_task"]]
+
+    async def _context_to_prompt(self, query, tools : List = None) -> str:
+        """Convert message format to prompt string"""
+        # Sections are ordered from the most stable to the most volatile, so that consecutive
+        # prompts share a long prefix for provider-side prefix caches and Ollama's KV cache
+        sections, history = await self._get_context_sections(query, tools)
+        prompt_parts = [REACT_INSTRUCTIONS]
+        for name in ["tools", "static_memory", "static_task"] :
+            if name in sections :
+                prompt_parts.append(sections[name])
         
         prompt_parts.append("## Conversation History:")
-        for msg in self.messages[:-1]:
+        for msg in history[:-1]:
             role = msg["role"].upper()
             content = msg["content"]
             prompt_parts.append(f"{role}: {content}")
+
+        for name in self._get_dynamic_section_names(sections) :
+            prompt_parts.append(sections[name])
         
-        prompt_parts.append(f"\nUser Query: {self.messages[-1]['content']}")
+        prompt_parts.append(f"\nUser Query: {history[-1]['content']}")
         prompt_parts.append("\nYour Answer:\n")
         
         return "\n".join(prompt_parts)
+
+    async def _context_to_messages(self, query, tools : List = None) -> Dict[str, List[Dict]] :
+        """
+        Convert the context to a chat prompt: the instructions, tools and static context become
+        cacheable system blocks, the conversation becomes role-tagged messages, and the per-turn
+        context is put in the last user message so that everything before it can be cached.
+        """
+        sections, history = await self._get_context_sections(query, tools)
+        system = [{"text" : "\n".join([self._get_instructions()] + [sections[name] for name in ["tools"] if name in sections]), "cache" : True}]
+        static_text = "\n".join(sections[name] for name in ["static_memory", "static_task"] if name in sections)
+        if len(static_text) > 0 :
+            system.append({"text" : static_text, "cache" : True})
+
+        # Chat APIs expect alternating roles, so consecutive messages of the same role are merged
+        messages = []
+        for msg in history :
+            if len(messages) > 0 and messages[-1]["role"] == msg["role"] :
+                messages[-1]["content"] += f"\n{msg['content']}"
+            else :
+                messages.append({"role" : msg["role"], "content" : msg["content"]})
+
+        context_text = "\n".join(sections[name] for name in self._get_dynamic_section_names(sections))
+        if messages[-1]["role"] == "user" :
+            messages[-1]["content"] = f"{context_text}\n\nUser Query: {messages[-1]['content']}".strip()
+        else :
+            messages.append({"role" : "user", "content" : f"{context_text}\n\nContinue with the user query: {query}".strip()})
+
+        if len(messages) > 1 :
+            messages[-2]["cache"] = True
+
+        prompt = {"system" : system, "messages" : messages}
+        if self.configs.get("structured_output", True) :
+            prompt["output_schema"] = await self._get_output_schema(tools, self.prompt_tools)
+        return prompt
+
+    async def _get_output_schema(self, tools : List = None, all_tools : Dict = None) -> Dict :
+        version = (self.memory.version, self.server_manager.version, tuple((all_tools or {}).keys()), tuple(tools) if isinstance(tools, List) else None)
+        return await self.section_cache.get("output_schema", version, lambda : self._build_output_schema(tools, all_tools))
+
+    async def _build_output_schema(self, tools : List = None, all_tools : Dict = None) -> Dict :
+        """
+        JSON schema of the response, used by providers with native JSON mode or tool calling.
+        The arguments of memory operations and tools follow their own input schemas.
+        """
+        def get_call_schema(entries) :
+            return {"anyOf" : [
+                {
+                    "type" : "object",
+                    "properties" : {
+                        "name" : {"type" : "string", "enum" : [entry["name"]]},
+                        "args" : entry["input_schema"],
+                    },
+                    "required" : ["name", "args"],
+                } for entry in entries
+            ]}
+
+        properties = {
+            "think" : {"type" : "string"},
+            "text" : {"type" : "string"},
+        }
+
+        operations = await self.memory.get_operations()
+        if len(operations) > 0 :
+            properties["mem_op"] = get_call_schema(operations.values())
+
+        # The tools gathered with the prompt, so that the tool list is not fetched again
+        listed_tools = [tool for tool in (all_tools or {}).values() if not isinstance(tools, List) or tool["name"] in tools]
+        if len(listed_tools) > 0 :
+            properties["tool"] = {"type" : "array", "items" : get_call_schema(listed_tools)}
+
+        properties["finished"] = {"type" : "boolean"}
+        return {"type" : "object", "properties" : properties, "required" : ["think", "text", "finished"]}
     
+    def _record_prompt_stability(self, prompt) -> None :
+        """Measure how many leading bytes of the prompt are unchanged since the previous turn"""
+        prompt_bytes = flatten_prompt(prompt).encode("utf-8")
+        prefix_stable_bytes = get_common_prefix_length(self.last_prompt_bytes, prompt_bytes)
+        self.last_prompt_bytes = prompt_bytes
+
+        self.prompt_stats["turns"] += 1
+        self.prompt_stats["prompt_bytes"] = len(prompt_bytes)
+        self.prompt_stats["prefix_stable_bytes"] = prefix_stable_bytes
+        self.prompt_stats["total_prompt_bytes"] += len(prompt_bytes)
+        self.prompt_stats["total_prefix_stable_bytes"] += prefix_stable_bytes
+        add_log(f"Prompt prefix-stable bytes: {prefix_stable_bytes} / {len(prompt_bytes)}", label = "log", print = False)
+
+    def get_prompt_stats(self) -> Dict[str, Any] :
+        total_prompt_bytes = self.prompt_stats["total_prompt_bytes"]
+        return {
+            **self.prompt_stats,
+            "prefix_stable_ratio" : self.prompt_stats["total_prefix_stable_bytes"] / total_prompt_bytes if total_prompt_bytes > 0 else 0.0,
+        }
+
     async def get_common_sense_context(self) : 
+        # A coarse time keeps the context identical between the turns of a conversation
         common_sense_parts = [
-            f"Curent date and time: {get_datetime()}"
+            f"Curent date and time: {get_datetime(self.configs.get('time_granularity', 'minute'))}"
         ]
         return "\n".join(common_sense_parts)
 
@@ -196,7 +411,13 @@ The result should be formatted in **JSON** dictionary and enclosed in **triple b
         output = {}
 
         try : 
-            content, data = split_content_and_json(text) 
+            # Structured outputs are plain JSON, free-text answers need the fenced JSON to be located first
+            try :
+                data = json.loads(text)
+            except json.JSONDecodeError :
+                data = None
+            if not isinstance(data, Dict) :
+                content, data = split_content_and_json(text) 
             add_log(f"Extracted data: {data}", label="log", print = False)
             if "text" in data.keys() :
                 output["text"] = data["text"]
@@ -204,8 +425,14 @@ The result should be formatted in **JSON** dictionary and enclosed in **triple b
                 output["think"] = data["think"]
             if isinstance(data.get("mem_op", None), Dict) and len(data["mem_op"]) > 0 :
                 output["mem_op"] = data["mem_op"]
-            if isinstance(data.get("tool", None), Dict) and len(data["tool"]) > 0:
-                output["tool"] = data["tool"]
+            # A single tool call is taken as a list of one
+            tool_calls = data.get("tool", None)
+            if isinstance(tool_calls, Dict) :
+                tool_calls = [tool_calls]
+            if isinstance(tool_calls, List) :
+                tool_calls = [call for call in tool_calls if isinstance(call, Dict) and len(call) > 0]
+                if len(tool_calls) > 0 :
+                    output["tool"] = tool_calls
             if "finished" in data.keys() :
                 output["finished"] = convert_to_boolean(data["finished"])
         except Exception as e:
@@ -213,8 +440,13 @@ The result should be formatted in **JSON** dictionary and enclosed in **triple b
         
         return output 
 
-    async def process_query(self, query: str, tools : List = None) -> str:
-        """Process a query using the LLM and available tools"""
+    async def process_query(self, query: str, tools : List = None, on_delta = None) -> str:
+        """
+        Process a query using the LLM and available tools.
+        If 'on_delta' is given, it is called as on_delta(delta, iteration) with the
+        partial text of the response while it is being generated.
+        """
+        self.messages = self.compactor.apply(self.messages)
         self.messages.append({"role": "user", "content": query})
         new_message_index = len(self.messages) 
         
@@ -224,11 +456,17 @@ The result should be formatted in **JSON** dictionary and enclosed in **triple b
         while iter < max_iters:
             iter_message_index = len(self.messages)
             iter += 1
+            # Collect the LLM calls of this iteration, for the usage recorded with its task log
+            llm_results.set([])
             
             # Get LLM response
-            response, finished = await self.react(query, tools)
+            stream_callback = None
+            if on_delta is not None :
+                stream_callback = functools.partial(on_delta, iteration = iter)
+            response, finished = await self.react(query, tools, stream_callback)
             need_next_interation = not finished 
             response_text = ""
+            tool_calls = []
 
             for content in response["content"]:
                 if content["type"] == "text":
@@ -287,53 +525,71 @@ The result should be formatted in **JSON** dictionary and enclosed in **triple b
                 elif content["type"] == "tool":
                     add_log("Process tool response", print = False)
                     need_next_interation = True 
-                    tool_name = content["name"]
-                    tool_args = content["args"]
-                    
-                    try:
-                        # Execute tool call
-                        result = await self.server_manager.call_tool(tool_name, tool_args)
-                        
-                        tool_use_info = {
-                            "name" : tool_name, 
-                            "args" : tool_args,
-                            "result" : "", 
-                        }
+                    tool_calls.append(content)
 
-                        if hasattr(result, "content") :
-                            for content in result.content :
-                                if content.type == "text" :
-                                    tool_use_info["result"] += f"{content.text}"
-                        else :
-                            tool_use_info["result"] = str(result)
-
-                        self.messages.append({
-                            "role": "assistant",
-                            "content": f"[Tool Called] name: {tool_name}, result: {tool_use_info}"
-                        })
-                        
-                    except Exception as e:
-                        error_msg = f"Error calling tool {tool_name}: {str(e)}"
-                        add_log(error_msg, label = "error")
-                        self.messages.append({
-                            "role": "assistant",
-                            "content": error_msg,
-                        })
+            # Tool calls run at the same time, their results are added in the order they were asked
+            if len(tool_calls) > 0 :
+                for tool_message in await self._call_tools(tool_calls) :
+                    self.messages.append({"role": "assistant", "content": tool_message})
 
             if iter_message_index < len(self.messages) :
-                await self.task_manager.update(query, self.messages[iter_message_index:])
+                await self.task_manager.submit_update(query, self.messages[iter_message_index:])
 
             if not need_next_interation:
                 break
             
+        llm_results.set(None)
+        self.compactor.schedule(self.messages)
         response = [] 
         if new_message_index < len(self.messages) :
             response = self.messages[new_message_index:]
 
         return response
     
+    async def _call_tools(self, tool_calls : List[Dict]) -> List[str] :
+        """Run tool calls concurrently, at most 'max_parallel' at once, returning a message for each"""
+        config = self.configs.get("tool_calls", {})
+        semaphore = asyncio.Semaphore(max(1, config.get("max_parallel", 4)))
+
+        async def run(tool_call) :
+            async with semaphore :
+                return await self._call_tool(tool_call["name"], tool_call["args"], config.get("timeout", 60.0))
+
+        return await asyncio.gather(*[run(tool_call) for tool_call in tool_calls])
+
+    async def _call_tool(self, tool_name : str, tool_args : Dict, timeout : float = None) -> str :
+        try:
+            # Execute tool call
+            result = await asyncio.wait_for(self.server_manager.call_tool(tool_name, tool_args), timeout = timeout)
+            
+            tool_use_info = {
+                "name" : tool_name, 
+                "args" : tool_args,
+                "result" : "", 
+            }
+
+            if hasattr(result, "content") :
+                for content in result.content :
+                    if content.type == "text" :
+                        tool_use_info["result"] += f"{content.text}"
+            else :
+                tool_use_info["result"] = str(result)
+
+            return f"[Tool Called] name: {tool_name}, result: {tool_use_info}"
+
+        except asyncio.TimeoutError:
+            error_msg = f"Error calling tool {tool_name}: no result after {timeout}s"
+        except Exception as e:
+            error_msg = f"Error calling tool {tool_name}: {str(e)}"
+        add_log(error_msg, label = "error")
+        return error_msg
+
     async def cleanup(self):
         """Clean up resources"""
+        await self.task_manager.flush()
+        await self.context_gatherer.close()
+        await self.compactor.close()
+        await self.router.close()
         await self.server_manager.cleanup()
 
 async def chat_loop(client):
@@ -345,7 +601,8 @@ async def chat_loop(client):
     
     while True:
         try:
-            query = input("\n[Query] ").strip()
+            # Read in a thread, so that background task updates go on while waiting for input
+            query = (await asyncio.to_thread(input, "\n[Query] ")).strip()
             
             if query.lower() == 'quit':
                 break
@@ -1,13 +1,13 @@
 
-import os, json, shutil, argparse, asyncio, time 
+import os, json, shutil, argparse, asyncio, time, functools, hashlib
 from datetime import datetime, timedelta
 import requests, subprocess
 from requests.exceptions import Timeout
 
-from typing import Optional, Dict, List, Tuple, Any
-from contextlib import AsyncExitStack
+from typing import Optional, Dict, List, Tuple, Any, Callable, Awaitable
+from collections import OrderedDict, deque
 
-from mcp import ClientSession, StdioServerParameters
+from mcp import ClientSession, StdioServerParameters, types
 from mcp.client.stdio import stdio_client
 from dotenv import load_dotenv
 load_dotenv()  # load environment variables from .env
@@ -16,6 +16,7 @@ from utils import *
 
 INDEX_PATH = "mcp_servers_index.json"
 MCP_SERVERS_DIR = ".mcp_servers"
+CATALOG_PATH = os.path.join(MCP_SERVERS_DIR, "tool_catalog.json")
 
 def download_files(root, files) : 
     for file in files : 
@@ -168,30 +169,396 @@ def remove_server(server_name):
     shutil.rmtree(server_dir)
     add_log(f"Deleted {server_name}.")
 
+# Directories of a server that do not hold its code, skipped when fingerprinting it
+FINGERPRINT_SKIP_DIRS = {".venv", "venv", "__pycache__", "node_modules", ".git"}
+
+def get_server_fingerprint(server_name: str, server_config: Dict, base_dir: str = MCP_SERVERS_DIR) -> str:
+    """
+    Hash of the configuration of a server and of its entry files, compared by size and modification
+    time: the files under its own directory, and the files named in its arguments or directly in the
+    directories named there (which may be data roots such as a home directory, so they are not walked).
+    """
+    digest = hashlib.sha256(json.dumps(server_config, sort_keys = True).encode("utf-8"))
+    files = set()
+    for root, dirs, names in os.walk(os.path.join(base_dir, server_name)):
+        dirs[:] = [name for name in dirs if name not in FINGERPRINT_SKIP_DIRS]
+        files.update(os.path.join(root, name) for name in names)
+    for path in [arg for arg in server_config.get("args", []) if isinstance(arg, str)]:
+        if os.path.isdir(path):
+            files.update(entry.path for entry in os.scandir(path) if entry.is_file())
+        elif os.path.isfile(path):
+            files.add(path)
+    for file_path in sorted(files):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        digest.update(f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return digest.hexdigest()
+
+class ToolCatalog:
+    """
+    Tools listed by each server, kept in memory and on disk so that servers do not have to be started
+    to know their tools. An entry is only used while the fingerprint of the server is unchanged and
+    it is younger than 'ttl' seconds.
+    """
+    
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.load()
+    
+    def load(self):
+        try:
+            self.entries = read_json(self.path)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            add_log(f"Error loading tool catalog: {e}", label = "warning")
+            self.entries = {}
+    
+    def save(self):
+        try:
+            write_json(self.entries, self.path)
+        except Exception as e:
+            add_log(f"Error saving tool catalog: {e}", label = "warning")
+    
+    def get(self, server_name: str, fingerprint: str, ttl: float = None) -> Optional[List[Dict[str, Any]]]:
+        entry = self.entries.get(server_name)
+        if entry is None or entry.get("fingerprint") != fingerprint:
+            return None
+        if ttl is not None and time.time() - entry.get("updated_at", 0) > ttl:
+            return None
+        return entry["tools"]
+    
+    def put(self, server_name: str, fingerprint: str, tools: List[Dict[str, Any]]):
+        self.entries[server_name] = {"fingerprint": fingerprint, "tools": tools, "updated_at": time.time()}
+        self.save()
+    
+    def clear(self):
+        self.entries = {}
+        self.save()
+
+class ToolResultCache:
+    """
+    Results of the tool calls of a server, for the tools declared in the 'result_cache' option of its
+    config.json, e.g. {"tools" : {"get_forecast" : {"ttl" : 600}}, "max_entries" : 256}. Entries
+    expire after the TTL of their tool and the least recently used are evicted beyond 'max_entries';
+    identical calls made while one is running wait for its result instead of calling the server again.
+    """
+    
+    def __init__(self, config: Dict = None):
+        self.config = config or {}
+        self.tools = self.config.get("tools", {})
+        self.max_entries = self.config.get("max_entries", 256)
+        self.entries = OrderedDict()
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+    
+    def get_ttl(self, tool_name: str) -> Optional[float]:
+        """TTL of the results of a tool, or None if they are not cached"""
+        tool_config = self.tools.get(tool_name)
+        return tool_config.get("ttl", 300.0) if isinstance(tool_config, Dict) else None
+    
+    @staticmethod
+    def make_key(tool_name: str, tool_args: Dict) -> str:
+        return hashlib.sha256(json.dumps([tool_name, tool_args], sort_keys = True, separators = (",", ":"), ensure_ascii = False).encode("utf-8")).hexdigest()
+    
+    async def get_or_call(self, tool_name: str, tool_args: Dict, call: Callable[[], Awaitable[Any]]) -> Any:
+        ttl = self.get_ttl(tool_name)
+        if ttl is None:
+            return await call()
+
+        key = self.make_key(tool_name, tool_args)
+        if key in self.entries:
+            expires, result = self.entries[key]
+            if time.monotonic() < expires:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return result
+            del self.entries[key]
+
+        if key in self.inflight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.inflight[key])
+
+        self.stats["misses"] += 1
+        task = asyncio.ensure_future(call())
+        self.inflight[key] = task
+        task.add_done_callback(lambda done: self._remember(key, ttl, done))
+        # The call goes on for the other waiters if this caller is cancelled
+        return await asyncio.shield(task)
+    
+    def _remember(self, key: str, ttl: float, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or getattr(task.result(), "isError", False):
+            return
+        self.entries[key] = (time.monotonic() + ttl, task.result())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "hit_rate": (self.stats["hits"] + self.stats["coalesced"]) / lookups if lookups > 0 else 0.0,
+        }
+
+class ServerBusyError(Exception):
+    """Raised when a tool call can not be queued for a server, or waited too long for a free instance"""
+
+class PoolInstance:
+    def __init__(self, index: int, session: ClientSession):
+        self.index = index
+        self.session = session
+        self.in_flight = 0
+        self.calls = 0
+
+class ServerPool:
+    """
+    The running instances of a server, configured by the 'pool' option of its config.json, e.g.
+    {"size" : 4, "max_in_flight" : 2, "max_queue" : 64, "queue_timeout" : 30.0}. A call goes to the
+    instance with the fewest calls in flight; when every instance has 'max_in_flight' calls, calls
+    wait in turn for a free instance, and beyond 'max_queue' waiting calls they are rejected.
+    """
+    
+    def __init__(self, config: Dict = None):
+        self.config = config or {}
+        self.size = max(1, self.config.get("size", 1))
+        self.max_in_flight = self.config.get("max_in_flight")
+        self.max_queue = self.config.get("max_queue", 64)
+        self.queue_timeout = self.config.get("queue_timeout", 30.0)
+        self.instances: Dict[int, PoolInstance] = {}
+        self.waiters = deque()
+        self.stats = {"calls": 0, "queued": 0, "rejected": 0}
+    
+    def add(self, index: int, session: ClientSession):
+        self.instances[index] = PoolInstance(index, session)
+        self._wake()
+    
+    def remove(self, index: int):
+        self.instances.pop(index, None)
+    
+    def get_session(self) -> Optional[ClientSession]:
+        """Session of any running instance, for requests other than tool calls"""
+        for instance in self.instances.values():
+            return instance.session
+        return None
+    
+    def _pick(self) -> Optional[PoolInstance]:
+        free = [instance for instance in self.instances.values() if self.max_in_flight is None or instance.in_flight < self.max_in_flight]
+        return min(free, key = lambda instance: instance.in_flight) if len(free) > 0 else None
+    
+    def _wake(self):
+        """Hand free instances to the calls waiting for them, first come first served"""
+        while len(self.waiters) > 0:
+            instance = self._pick()
+            if instance is None:
+                return
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                instance.in_flight += 1
+                waiter.set_result(instance)
+    
+    async def acquire(self) -> PoolInstance:
+        self.stats["calls"] += 1
+        instance = self._pick() if len(self.waiters) == 0 else None
+        if instance is not None:
+            instance.in_flight += 1
+            return instance
+
+        if len(self.waiters) >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise ServerBusyError(f"{len(self.waiters)} calls are already waiting")
+        self.stats["queued"] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout = self.queue_timeout)
+        except BaseException as e:
+            # An instance handed over just as the wait ended is given back
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result())
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["rejected"] += 1
+                raise ServerBusyError(f"no instance free after {self.queue_timeout}s")
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+    
+    def release(self, instance: PoolInstance):
+        instance.in_flight -= 1
+        instance.calls += 1
+        self._wake()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "waiting": len(self.waiters),
+            "instances": [{"index": instance.index, "in_flight": instance.in_flight, "calls": instance.calls} for instance in self.instances.values()],
+        }
+
 class MCPServerManager:
     """Manages multiple MCP server connections"""
     
-    def __init__(self):
+    def __init__(self, config: Dict = None):
+        self.config = config or {}
         self.servers: Dict[str, Dict] = {}
         self.sessions: Dict[str, ClientSession] = {}
-        self.exit_stack = AsyncExitStack()
+        # Each server instance runs in a task of its own, keyed by (server name, instance index), which enters
+        # and exits its stdio and session contexts, so that servers can be started concurrently and stopped
+        # one at a time; 'sessions' holds a session of each running server for requests other than tool calls
+        self.runners: Dict[Tuple[str, int], asyncio.Task] = {}
+        self.stop_events: Dict[Tuple[str, int], asyncio.Event] = {}
+        self.pools: Dict[str, ServerPool] = {}
+        self.retry_tasks: Dict[str, asyncio.Task] = {}
+        self.closing = False
+        # Lazy servers are started on their first tool call and stopped after 'idle_timeout' seconds without calls
+        self.catalog = ToolCatalog(self.config.get("catalog_path", CATALOG_PATH))
+        self.start_locks: Dict[str, asyncio.Lock] = {}
+        self.last_used: Dict[str, float] = {}
+        self.active_calls: Dict[str, int] = {}
+        self.reaper = None
+        self.fingerprints: Dict[str, str] = {}
+        self.result_caches: Dict[str, ToolResultCache] = {}
+        # Bumped when the tool list changes, to refresh the prompt sections built from it
+        self.version = 0
+        # Tools listed by each server, and the routing table from the exposed tool names
+        # to the server and the name the server knows the tool by
+        self.server_tools: Dict[str, List[Dict[str, Any]]] = {}
+        self.tools: Dict[str, Dict[str, Any]] = {}
+        self.routes: Dict[str, Tuple[str, str]] = {}
+        self.stale_servers = set()
     
+    def invalidate_tools(self):
+        """Mark the tool list as changed"""
+        self.version += 1
+
     async def load_servers_config(self, configs):
         """Load server configurations from JSON file"""
         self.servers = configs
+        # Fingerprints stat the files of each server, which is done off the event loop
+        fingerprints = await asyncio.gather(*[asyncio.to_thread(get_server_fingerprint, server_name, server_config) for server_name, server_config in configs.items()])
+        self.fingerprints = dict(zip(configs.keys(), fingerprints))
+        self.result_caches = {server_name: ToolResultCache(server_config["result_cache"]) for server_name, server_config in configs.items() if "result_cache" in server_config}
+        self.pools = {server_name: ServerPool({**self.config.get("pool", {}), **server_config.get("pool", {})}) for server_name, server_config in configs.items()}
+        self.invalidate_tools()
         add_log(f"Loaded {len(self.servers)} MCP server configurations")
     
+    def is_lazy(self, server_name: str) -> bool:
+        return self.servers.get(server_name, {}).get("lazy", self.config.get("lazy", False))
+    
+    def get_catalog_tools(self, server_name: str) -> Optional[List[Dict[str, Any]]]:
+        """Tools of a server from the catalog, if they were listed by the same version of the server recently enough"""
+        return self.catalog.get(server_name, self.fingerprints.get(server_name), self.config.get("catalog_ttl", 86400.0))
+    
+    def get_idle_timeout(self, server_name: str) -> float:
+        return self.servers.get(server_name, {}).get("idle_timeout", self.config.get("idle_timeout", 300.0))
+    
     async def connect_all_servers(self):
-        """Connect to all configured servers"""
+        """
+        Connect to all configured servers at once, at most 'max_concurrent_starts' starting at a time.
+        This returns when every server is connected or has failed within its 'connect_timeout';
+        failed servers are retried in the background.
+        """
+        semaphore = asyncio.Semaphore(max(1, self.config.get("max_concurrent_starts", 4)))
+
+        # Tools in the catalog are known before their servers are connected, and lazy servers
+        # whose tools are in the catalog are not started until one of their tools is called
+        servers = {}
         for server_name, server_config in self.servers.items():
-            try:
-                await self._connect_server(server_name, server_config)
-                add_log(f"Connected to MCP server: {server_name}", label = "success")
-            except Exception as e:
-                add_log(f"Failed to connect to MCP server {server_name}: {e}", label = "error")
+            tools = self.get_catalog_tools(server_name)
+            if tools is not None:
+                self.server_tools[server_name] = tools
+            if tools is None or not self.is_lazy(server_name):
+                servers[server_name] = server_config
+        self._build_routes()
+        if any(self.is_lazy(server_name) for server_name in self.servers) and self.reaper is None:
+            self.reaper = asyncio.ensure_future(self._reap_idle_servers())
+
+        async def connect(server_name, server_config):
+            async with semaphore:
+                try:
+                    await self._connect_server(server_name, server_config)
+                    add_log(f"Connected to MCP server: {server_name}", label = "success")
+                except Exception as e:
+                    add_log(f"Failed to connect to MCP server {server_name}: {e}", label = "error")
+                    self._schedule_retry(server_name, server_config)
+
+        await asyncio.gather(*[connect(server_name, server_config) for server_name, server_config in servers.items()])
     
     async def _connect_server(self, server_name: str, server_config: Dict):
-        """Connect to a single MCP server"""
+        """Connect to a single MCP server, starting the instances of its pool that are not running"""
+        pool = self.pools.setdefault(server_name, ServerPool(server_config.get("pool", {})))
+        indices = [index for index in range(pool.size) if (server_name, index) not in self.runners]
+        results = await asyncio.gather(*[self._start_instance(server_name, server_config, index) for index in indices], return_exceptions = True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if server_name not in self.sessions:
+            raise errors[0] if len(errors) > 0 else ConnectionError("no instance is running")
+        if len(errors) > 0:
+            # The instances that are not running are started again by the retry
+            add_log(f"{len(errors)} of {pool.size} instances of MCP server {server_name} failed to start: {errors[0]}", label = "warning")
+            self._schedule_retry(server_name, server_config)
+
+        self.last_used[server_name] = time.monotonic()
+        tools = self.get_catalog_tools(server_name)
+        if tools is None or server_name in self.stale_servers:
+            await self.refresh_server_tools(server_name)
+        elif server_name not in self.server_tools:
+            # The tools of a server that stopped are routed again from its catalog entry
+            self.server_tools[server_name] = tools
+            self._build_routes()
+    
+    async def _start_instance(self, server_name: str, server_config: Dict, index: int):
+        timeout = server_config.get("connect_timeout", self.config.get("connect_timeout", 30.0))
+        ready = asyncio.get_running_loop().create_future()
+        self.stop_events[(server_name, index)] = asyncio.Event()
+        self.runners[(server_name, index)] = asyncio.create_task(self._run_server(server_name, server_config, ready, index))
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), timeout = timeout)
+        except asyncio.TimeoutError:
+            ready.cancel()
+            await self._stop_instance((server_name, index), cancel = True)
+            raise TimeoutError(f"not ready after {timeout}s")
+        except BaseException:
+            ready.cancel()
+            await self._stop_instance((server_name, index), cancel = True)
+            raise
+    
+    async def _get_session(self, server_name: str) -> ClientSession:
+        """Session of a server, starting the server first if it is a lazy server that is not running"""
+        if server_name in self.sessions:
+            return self.sessions[server_name]
+        if not self.is_lazy(server_name):
+            raise ConnectionError(f"MCP server {server_name} is not connected")
+        async with self.start_locks.setdefault(server_name, asyncio.Lock()):
+            if server_name not in self.sessions:
+                add_log(f"Starting lazy MCP server: {server_name}")
+                await self._connect_server(server_name, self.servers[server_name])
+        return self.sessions[server_name]
+    
+    async def _reap_idle_servers(self):
+        """Stop the lazy servers that have had no tool call for their 'idle_timeout'"""
+        while True:
+            await asyncio.sleep(self.config.get("reap_interval", 10.0))
+            for server_name in list(self.sessions.keys()):
+                if not self.is_lazy(server_name) or not self._is_idle(server_name):
+                    continue
+                # Calls arriving while the server stops wait for the lock and then start it again
+                async with self.start_locks.setdefault(server_name, asyncio.Lock()):
+                    if server_name in self.sessions and self._is_idle(server_name):
+                        add_log(f"Stopping idle MCP server: {server_name}")
+                        await self._stop_server(server_name)
+    
+    def _is_idle(self, server_name: str) -> bool:
+        now = time.monotonic()
+        return self.active_calls.get(server_name, 0) == 0 and now - self.last_used.get(server_name, now) > self.get_idle_timeout(server_name)
+    
+    async def _run_server(self, server_name: str, server_config: Dict, ready: asyncio.Future, index: int = 0):
+        """Start a server process and keep its session open until the server instance is stopped"""
         command = server_config["command"]
         args = server_config.get("args", [])
         env = server_config.get("env")
@@ -202,59 +569,206 @@ class MCPServerManager:
             env=env
         )
         
-        stdio_transport = await self.exit_stack.enter_async_context(
-            stdio_client(server_params)
-        )
-        stdio, write = stdio_transport
-        session = await self.exit_stack.enter_async_context(
-            ClientSession(stdio, write)
-        )
-        
-        await session.initialize()
-        self.sessions[server_name] = session
+        try:
+            async with stdio_client(server_params) as (stdio, write):
+                async with ClientSession(stdio, write, message_handler = functools.partial(self._handle_message, server_name)) as session:
+                    await session.initialize()
+                    self.pools[server_name].add(index, session)
+                    self.sessions.setdefault(server_name, session)
+                    ready.set_result(session)
+                    await self.stop_events[(server_name, index)].wait()
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e if isinstance(e, Exception) else ConnectionError("server stopped while starting"))
+            elif not self.stop_events[(server_name, index)].is_set() and not self.closing:
+                add_log(f"MCP server {server_name} (instance {index}) exited: {e}", label = "error")
+                # A lazy server is started again by its next tool call
+                if not self.is_lazy(server_name):
+                    self._schedule_retry(server_name, server_config)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            # An instance that exited by itself is no longer running, so that a retry starts it again
+            if self.runners.get((server_name, index)) is asyncio.current_task():
+                self.runners.pop((server_name, index))
+            self._detach_instance(server_name, index)
+            # The tools of a stopped lazy server stay routed, to start it again when they are called
+            if server_name not in self.sessions and not self.is_lazy(server_name) and server_name in self.server_tools:
+                self.server_tools.pop(server_name, None)
+                self._build_routes()
+    
+    def _detach_instance(self, server_name: str, index: int):
+        """Stop handing out the session of a server instance to new calls"""
+        pool = self.pools[server_name]
+        if index in pool.instances and pool.instances[index].session is self.sessions.get(server_name):
+            self.sessions.pop(server_name)
+        pool.remove(index)
+        if server_name not in self.sessions and pool.get_session() is not None:
+            self.sessions[server_name] = pool.get_session()
+    
+    async def _stop_server(self, server_name: str, cancel: bool = False):
+        """Close the sessions of all instances of a server and wait for their processes to exit"""
+        keys = [key for key in self.runners if key[0] == server_name]
+        # Every instance is detached before any of them is waited for
+        for key in keys:
+            self._detach_instance(*key)
+        await asyncio.gather(*[self._stop_instance(key, cancel) for key in keys])
+    
+    async def _stop_instance(self, key: Tuple[str, int], cancel: bool = False):
+        self._detach_instance(*key)
+        if key in self.stop_events:
+            self.stop_events[key].set()
+        runner = self.runners.pop(key, None)
+        if runner is None:
+            return
+        if not cancel:
+            await asyncio.wait([runner], timeout = self.config.get("stop_timeout", 5.0))
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions = True)
+    
+    def _schedule_retry(self, server_name: str, server_config: Dict):
+        if self.closing or server_name in self.retry_tasks:
+            return
+        self.retry_tasks[server_name] = asyncio.ensure_future(self._retry_server(server_name, server_config))
+    
+    async def _retry_server(self, server_name: str, server_config: Dict):
+        """Try to connect a failed server again, waiting longer after each failed attempt"""
+        delay = self.config.get("retry_delay", 5.0)
+        try:
+            for attempt in range(self.config.get("retry_attempts", 3)):
+                await asyncio.sleep(delay * (2 ** attempt))
+                try:
+                    await self._connect_server(server_name, server_config)
+                    # Instances of a pool that still failed to start are tried again on the next attempt
+                    missing = [index for index in range(self.pools[server_name].size) if (server_name, index) not in self.runners]
+                    if len(missing) == 0:
+                        add_log(f"Connected to MCP server: {server_name} (retry {attempt + 1})", label = "success")
+                        return
+                    add_log(f"Retry {attempt + 1}: {len(missing)} instances of MCP server {server_name} are not running", label = "warning")
+                except Exception as e:
+                    add_log(f"Retry {attempt + 1} failed for MCP server {server_name}: {e}", label = "warning")
+            add_log(f"Gave up connecting to MCP server {server_name}", label = "error")
+        finally:
+            self.retry_tasks.pop(server_name, None)
+    
+    async def _handle_message(self, server_name: str, message: Any):
+        """Mark the tools of a server as stale when it notifies that they changed"""
+        # The notification is wrapped in a root model by some versions of the SDK
+        notification = getattr(message, "root", message)
+        if isinstance(notification, types.ToolListChangedNotification):
+            add_log(f"Tool list of MCP server {server_name} changed")
+            # The list is fetched on the next use, not from the handler, which runs in the session's receive loop
+            self.stale_servers.add(server_name)
+            self.invalidate_tools()
+    
+    async def refresh_server_tools(self, server_name: str):
+        """List the tools of a server and rebuild the routing table"""
+        try:
+            response = await self.sessions[server_name].list_tools()
+            self.server_tools[server_name] = [
+                {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "input_schema": tool.inputSchema,
+                    "server": server_name
+                } for tool in response.tools
+            ]
+            self.stale_servers.discard(server_name)
+            self.catalog.put(server_name, self.fingerprints.get(server_name), self.server_tools[server_name])
+        except Exception as e:
+            add_log(f"Error getting tools from {server_name}: {e}", label = "error")
+            self.stale_servers.add(server_name)
+        self._build_routes()
+    
+    def _build_routes(self):
+        """
+        Map each tool name to its server. A name listed by several servers is exposed as
+        '<server>__<name>' for each of them, so that none of them shadows the others.
+        """
+        owners = {}
+        for server_name, tools in self.server_tools.items():
+            for tool in tools:
+                owners.setdefault(tool["name"], []).append(server_name)
+
+        self.tools, self.routes = {}, {}
+        for server_name, tools in self.server_tools.items():
+            for tool in tools:
+                name = tool["name"] if len(owners[tool["name"]]) == 1 else f"{server_name}__{tool['name']}"
+                self.tools[name] = {**tool, "name": name}
+                self.routes[name] = (server_name, tool["name"])
+        self.invalidate_tools()
+    
+    async def _refresh_stale_servers(self):
+        # Running servers whose catalog entry has expired are listed again
+        for server_name in self.sessions:
+            if self.get_catalog_tools(server_name) is None:
+                self.stale_servers.add(server_name)
+        stale_servers = [server_name for server_name in self.stale_servers if server_name in self.sessions]
+        if len(stale_servers) > 0:
+            await asyncio.gather(*[self.refresh_server_tools(server_name) for server_name in stale_servers])
     
     async def get_tools(self) -> Dict[str, Any]:
         """Get all available tools from all connected servers"""
-        all_tools = {}
-        
-        for server_name, session in self.sessions.items():
-            try:
-                response = await session.list_tools()
-                for tool in response.tools:
-                    tool_info = {
-                        "name": tool.name,
-                        "description": tool.description,
-                        "input_schema": tool.inputSchema,
-                        "server": server_name
-                    }
-                    all_tools[tool.name] = tool_info
-            except Exception as e:
-                add_log(f"Error getting tools from {server_name}: {e}", label = "error")
-        
-        return all_tools
+        await self._refresh_stale_servers()
+        return self.tools
     
     async def call_tool(self, tool_name: str, tool_args: Dict) -> Any:
-        """Call a tool on the appropriate server"""
-        # Find which server has this tool
-        for server_name, session in self.sessions.items():
+        """Call a tool on the server it is routed to"""
+        if tool_name not in self.routes:
+            await self._refresh_stale_servers()
+        if tool_name not in self.routes:
+            raise ValueError(f"Tool {tool_name} not found on any connected server")
+
+        server_name, server_tool_name = self.routes[tool_name]
+        call = functools.partial(self._call_server_tool, server_name, server_tool_name, tool_args)
+        if server_name in self.result_caches:
+            return await self.result_caches[server_name].get_or_call(server_tool_name, tool_args, call)
+        return await call()
+    
+    async def _call_server_tool(self, server_name: str, server_tool_name: str, tool_args: Dict) -> Any:
+        self.active_calls[server_name] = self.active_calls.get(server_name, 0) + 1
+        try:
+            await self._get_session(server_name)
+            # The call goes to the least loaded instance of the server, waiting for one if all are busy
+            pool = self.pools[server_name]
+            instance = await pool.acquire()
             try:
-                response = await session.list_tools()
-                tool_names = [tool.name for tool in response.tools]
-                
-                if tool_name in tool_names:
-                    result = await session.call_tool(tool_name, tool_args)
-                    return result
-            except Exception as e:
-                add_log(f"Error calling tool {tool_name} on {server_name}: {e}", label = "error")
-        
-        raise ValueError(f"Tool {tool_name} not found on any connected server")
+                return await instance.session.call_tool(server_tool_name, tool_args)
+            finally:
+                pool.release(instance)
+        finally:
+            self.active_calls[server_name] -= 1
+            self.last_used[server_name] = time.monotonic()
+    
+    def get_cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hits, misses and coalesced calls of the tool result cache of each server"""
+        return {server_name: cache.get_stats() for server_name, cache in self.result_caches.items()}
+    
+    def get_pool_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Calls, queued and rejected calls, and the load of each instance of the running servers"""
+        return {server_name: pool.get_stats() for server_name, pool in self.pools.items() if len(pool.instances) > 0}
     
     async def cleanup(self):
         """Clean up all server connections"""
-        await self.exit_stack.aclose()
+        self.closing = True
+        if self.reaper is not None:
+            self.reaper.cancel()
+            await asyncio.gather(self.reaper, return_exceptions = True)
+            self.reaper = None
+        retry_tasks = list(self.retry_tasks.values())
+        for task in retry_tasks:
+            task.cancel()
+        await asyncio.gather(*retry_tasks, return_exceptions = True)
+        await asyncio.gather(*[self._stop_server(server_name) for server_name in {server_name for server_name, index in self.runners}])
+        self.sessions.clear()
+        self.server_tools.clear()
+        self._build_routes()
 
-async def list_servers() : 
-    manager = MCPServerManager()
+async def list_servers(refresh = False) : 
+    # Servers are only started to list the tools that are not in the catalog
+    manager = MCPServerManager({"lazy" : True})
+    if refresh :
+        manager.catalog.clear()
     configs = collect_mcp_server_configs()
     await manager.load_servers_config(configs)
     await manager.connect_all_servers()
@@ -278,7 +792,8 @@ async def main():
     remove_parser = subparsers.add_parser("remove", help = "Delete installed MCP server.")
     remove_parser.add_argument("name", help="MCP server name")
     
-    subparsers.add_parser("list", help="List MCP servers.")
+    list_parser = subparsers.add_parser("list", help="List MCP servers.")
+    list_parser.add_argument("--refresh", action="store_true", help="Start the servers to list their tools instead of reading the tool catalog.")
     
     args = parser.parse_args()
     
@@ -287,7 +802,7 @@ async def main():
     elif args.command == "remove":
         remove_server(args.name)
     elif args.command == "list":
-        await list_servers()
+        await list_servers(args.refresh)
 
 os.makedirs('.mcp_servers', exist_ok=True)
 
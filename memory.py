@@ -5,6 +5,7 @@ from abc import ABC, abstractmethod
 from urllib.parse import quote
 
 from provider import *
+from prompt import SectionCache
 from utils import *
 
 class MemoryOperation : 
@@ -40,20 +41,13 @@ class Memory :
     def __init__(self, client, config) : 
         self.client = client
         self.config = config
-        self.provider = None
-
-        provider_config = self.config.get("provider", {})
-        provider_name = provider_config.get("name", None)
-        provider_cls = get_provider(provider_name) 
-        if provider_cls is not None : 
-            self.provider = provider_cls(provider_config)
-            add_log(f"Memery is using provider: {provider_name}")
-        else:
-            self.provider = self.client.provider
-            add_log(f"Memory is using the client's provider.")
+        self.provider = self.client.router.get_provider("memory_consolidate")
 
         self.records = []
         self.summary, self.topics, self.database = {}, {}, {} 
+        # Bumped whenever the operations change, to rebuild the cached static context
+        self.version = 0
+        self.section_cache = SectionCache()
         self.prepare_operations()
 
         self.timelabel = f"{get_random_label()}"
@@ -91,6 +85,9 @@ class Memory :
             add_log(f"Error loading memory: {e}", label="error")
     
     async def get_static_context(self) -> str : 
+        return await self.section_cache.get("static_context", self.version, self._build_static_context)
+
+    async def _build_static_context(self) -> str : 
         memory_parts = [] 
         memory_parts.append("\n## Memory Usage:")
         memory_parts.append(
@@ -143,7 +140,13 @@ class Memory :
 
         return "\n".join(memory_parts)
 
+    def register_operation(self, name : str, func : Any, config : Dict = None) -> None :
+        """Add or replace a memory operation"""
+        self.operations[name] = MemoryOperation(name, func, config)
+        self.version += 1
+
     def prepare_operations(self) -> None :
+        self.version += 1
         self.operations = {
             "add_memory_record" : MemoryOperation("add_memory_record", self.add_memory_record, {
                 "title" : "Add Memory Record",
@@ -296,7 +299,7 @@ class Memory :
 
         try:
             if self.provider:
-                response = await self.provider.generate_response(prompt)
+                response = await self.provider.generate_response(prompt, use_cache = True, priority = PRIORITY_BACKGROUND)
                 
                 # Extract JSON from response
                 content, data = split_content_and_json(response)
@@ -0,0 +1,118 @@
+import json, time
+import argparse
+from typing import Dict, List
+from aiohttp import web
+
+from provider import MockProvider, ProviderError, LLMResult, flatten_prompt
+from utils import *
+
+class MockServer :
+    """Local stand-in for an OpenAI compatible 'chat/completions' API, serving the replies of a MockProvider"""
+
+    def __init__(self, config = None) :
+        self.config = config or {}
+        self.provider = MockProvider({"name" : "Mock", **self.config})
+        self.stats = {"requests" : 0, "errors" : 0, "streams" : 0}
+
+    def get_app(self) -> web.Application :
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    def _get_usage(self, messages : List[Dict], text : str) -> Dict[str, int] :
+        prompt = flatten_prompt({"messages" : [{"role" : msg["role"], "content" : self._get_content(msg)} for msg in messages]})
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(self.provider.split_tokens(text))
+        return {"prompt_tokens" : prompt_tokens, "completion_tokens" : completion_tokens, "total_tokens" : prompt_tokens + completion_tokens}
+
+    def _to_prompt(self, payload : Dict) -> Dict :
+        """Chat prompt of a request, asking for a structured output if JSON mode is requested"""
+        prompt = {"messages" : [{"role" : msg["role"], "content" : self._get_content(msg)} for msg in payload.get("messages", [])]}
+        if payload.get("response_format", {}).get("type") in ["json_object", "json_schema"] :
+            prompt["output_schema"] = payload["response_format"].get("json_schema", {}).get("schema", {})
+        return prompt
+
+    def _get_content(self, message : Dict) -> str :
+        """Message content as text, joining the parts of a content list"""
+        content = message.get("content", "")
+        if isinstance(content, List) :
+            content = "".join(part.get("text", "") for part in content)
+        return content
+
+    async def chat_completions(self, request : web.Request) -> web.StreamResponse :
+        payload = await request.json()
+        self.stats["requests"] += 1
+        model = payload.get("model", self.provider.model)
+        completion_id = f"chatcmpl-mock-{self.stats['requests']}"
+        created = int(time.time())
+
+        if payload.get("stream", False) :
+            self.stats["streams"] += 1
+            stream = self.provider._stream_response(self._to_prompt(payload))
+            try :
+                first_token = await anext(stream)
+            except ProviderError as e :
+                self.stats["errors"] += 1
+                return web.json_response({"error" : {"message" : str(e)}}, status = e.status)
+            except StopAsyncIteration :
+                first_token = ""
+
+            response = web.StreamResponse(headers = {"Content-Type" : "text/event-stream"})
+            await response.prepare(request)
+            text = first_token
+            await self._write_chunk(response, completion_id, created, model, {"role" : "assistant", "content" : first_token})
+            async for token in stream :
+                if isinstance(token, LLMResult) :
+                    continue
+                text += token
+                await self._write_chunk(response, completion_id, created, model, {"content" : token})
+            await self._write_chunk(response, completion_id, created, model, {}, "stop", self._get_usage(payload.get("messages", []), text))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+
+        try :
+            text = (await self.provider._generate_response(self._to_prompt(payload))).text
+        except ProviderError as e :
+            self.stats["errors"] += 1
+            return web.json_response({"error" : {"message" : str(e)}}, status = e.status)
+
+        return web.json_response({
+            "id" : completion_id,
+            "object" : "chat.completion",
+            "created" : created,
+            "model" : model,
+            "choices" : [{"index" : 0, "message" : {"role" : "assistant", "content" : text}, "finish_reason" : "stop"}],
+            "usage" : self._get_usage(payload.get("messages", []), text),
+        })
+
+    async def _write_chunk(self, response, completion_id, created, model, delta, finish_reason = None, usage = None) -> None :
+        chunk = {
+            "id" : completion_id,
+            "object" : "chat.completion.chunk",
+            "created" : created,
+            "model" : model,
+            "choices" : [{"index" : 0, "delta" : delta, "finish_reason" : finish_reason}],
+        }
+        if usage is not None :
+            chunk["usage"] = usage
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii = False)}\n\n".encode("utf-8"))
+
+    async def get_stats(self, request : web.Request) -> web.Response :
+        return web.json_response(self.stats)
+
+def main() :
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI compatible LLM server for offline benchmarks.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8800, help='Port to listen on')
+    parser.add_argument('--config-path', type=str, default=None, help='Path to a JSON file with the mock provider options')
+
+    args = parser.parse_args()
+    config = read_json(args.config_path) if args.config_path is not None else {}
+
+    add_log(f"Mock LLM server listening on http://{args.host}:{args.port}/v1/chat/completions")
+    web.run_app(MockServer(config).get_app(), host = args.host, port = args.port, print = None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+import time, asyncio
+from typing import Optional, Dict, List, Tuple, Any, Callable, Awaitable
+
+from provider import PRIORITY_BACKGROUND
+from utils import *
+
+# Share of the prompt budget left by the fixed sections (e.g. the instructions) each section
+# may use before it is truncated; sections that need less leave the rest to the others, in
+# order of priority
+DEFAULT_QUOTAS = {
+    "common_sense" : 0.05,
+    "tools" : 0.25,
+    "static_memory" : 0.1,
+    "dynamic_memory" : 0.1,
+    "static_task" : 0.05,
+    "dynamic_task" : 0.1,
+    "history" : 0.35,
+}
+
+class ContextSource :
+    """
+    A named part of the prompt context, fetched as fetch(query). A shared source does not depend
+    on the query, so a fetch started for one query is used for the others.
+    """
+
+    def __init__(self, name : str, fetch : Callable[[str], Awaitable[Any]], title : str = None, timeout : float = None, default : Any = "", shared : bool = False) :
+        self.name = name
+        self.fetch = fetch
+        self.title = title
+        self.timeout = timeout
+        self.default = default
+        self.shared = shared
+        self.value = default
+        self.value_key = None
+        self.inflight : Dict[Any, asyncio.Future] = {}
+        self.stats = {"calls" : 0, "timeouts" : 0, "errors" : 0, "latency" : 0.0}
+
+    def get_key(self, query : str) -> Any :
+        return None if self.shared else query
+
+    def get_value(self, query : str) -> Any :
+        """The last known value, or the default if it was fetched for another query"""
+        return self.value if self.value_key == self.get_key(query) else self.default
+
+class ContextGatherer :
+    """
+    Fetches the context sources of a prompt concurrently. A source slower than its timeout is left
+    running in the background and its last known value for the same query is used instead; the next
+    gathering for that query waits on the same fetch rather than starting another one. A failed
+    source also falls back to its last value.
+    """
+
+    def __init__(self, config = None) :
+        self.config = config or {}
+        self.timeout = self.config.get("timeout", 5.0)
+        self.timeouts = self.config.get("timeouts", {})
+        self.sources : Dict[str, ContextSource] = {}
+
+    def add_source(self, name : str, fetch : Callable[[str], Awaitable[Any]], title : str = None, timeout : float = None, default : Any = "", shared : bool = False) -> None :
+        timeout = self.timeouts.get(name, timeout if timeout is not None else self.timeout)
+        self.sources[name] = ContextSource(name, fetch, title, timeout, default, shared)
+
+    def remove_source(self, name : str) -> None :
+        source = self.sources.pop(name, None)
+        if source is not None :
+            for inflight in source.inflight.values() :
+                inflight.cancel()
+
+    def get_titles(self) -> Dict[str, str] :
+        return {name : source.title for name, source in self.sources.items() if source.title is not None}
+
+    async def _fetch(self, source : ContextSource, query : str) -> Any :
+        key = source.get_key(query)
+        if key not in source.inflight :
+            source.stats["calls"] += 1
+            source.inflight[key] = asyncio.ensure_future(source.fetch(query))
+        inflight, start = source.inflight[key], time.perf_counter()
+        try :
+            value = await asyncio.wait_for(asyncio.shield(inflight), timeout = source.timeout)
+        except asyncio.TimeoutError :
+            source.stats["timeouts"] += 1
+            add_log(f"Context source '{source.name}' timed out after {source.timeout}s, using its last value", label = "warning")
+            inflight.add_done_callback(lambda done : self._keep_value(source, key, done))
+            return source.get_value(query)
+        except Exception as e :
+            source.stats["errors"] += 1
+            add_log(f"Error getting context source '{source.name}': {e}", label = "warning")
+            if source.inflight.get(key) is inflight :
+                source.inflight.pop(key)
+            return source.get_value(query)
+        source.stats["latency"] = time.perf_counter() - start
+        self._keep_value(source, key, inflight)
+        return source.get_value(query)
+
+    def _keep_value(self, source : ContextSource, key : Any, done : asyncio.Future) -> None :
+        if source.inflight.get(key) is done :
+            source.inflight.pop(key)
+        if not done.cancelled() and done.exception() is None :
+            source.value, source.value_key = done.result(), key
+
+    async def gather(self, query : str = None) -> Dict[str, Any] :
+        """Values of every source, taking as long as the slowest source within its timeout"""
+        sources = list(self.sources.values())
+        values = await asyncio.gather(*[self._fetch(source, query) for source in sources])
+        return {source.name : value for source, value in zip(sources, values)}
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]] :
+        return {name : dict(source.stats) for name, source in self.sources.items()}
+
+    async def close(self) -> None :
+        inflight = [task for source in self.sources.values() for task in source.inflight.values()]
+        for task in inflight :
+            task.cancel()
+        await asyncio.gather(*inflight, return_exceptions = True)
+
+class SectionCache :
+    """
+    Rendered prompt sections, kept until the version they were built for changes. The version is
+    any comparable value made of the counters its inputs bump when they change, e.g. when memory
+    operations are registered or MCP servers connect.
+    """
+
+    def __init__(self) :
+        self.entries : Dict[str, Tuple[Any, Any]] = {}
+        self.stats = {"hits" : 0, "misses" : 0}
+
+    async def get(self, name : str, version : Any, build : Callable[[], Any]) -> Any :
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == version :
+            self.stats["hits"] += 1
+            return entry[1]
+        self.stats["misses"] += 1
+        value = build()
+        if asyncio.iscoroutine(value) :
+            value = await value
+        self.entries[name] = (version, value)
+        return value
+
+    def invalidate(self, name : str = None) -> None :
+        if name is None :
+            self.entries.clear()
+        else :
+            self.entries.pop(name, None)
+
+    def get_stats(self) -> Dict[str, Any] :
+        return {**self.stats, "sections" : list(self.entries.keys())}
+
+class PromptSection :
+    """A part of the prompt made of items that can be dropped or compacted to fit its allowance"""
+
+    def __init__(self, name : str, items : List[Any], priority : int = 0, quota : float = 1.0, keep : str = "head",
+                 compact_items : List[Any] = None, min_items : int = 0, to_text : Callable[[Any], str] = str, fixed : bool = False) :
+        self.name = name
+        self.items = list(items)
+        self.priority = priority
+        self.quota = quota
+        self.fixed = fixed
+        self.keep = keep
+        self.compact_items = compact_items
+        self.min_items = min_items
+        self.to_text = to_text
+        self.item_tokens = [estimate_tokens(self.to_text(item)) for item in self.items]
+        self.tokens = sum(self.item_tokens)
+
+class PromptBuilder :
+    """
+    Fits the sections of a prompt into a token budget. Fixed sections (e.g. the instructions) are
+    never cut and are taken out of the budget first; each other section is allowed its quota of
+    what is left, the lowest priority sections (a higher value) are cut first when the quotas add
+    up to more than that, and the budget left by smaller sections is handed out in order of priority
+    (a lower value first). Sections beyond their allowance are compacted and truncated: items are
+    dropped from the end ('keep' = "head") or from the start ('keep' = "tail", e.g. for the
+    conversation history).
+    """
+
+    def __init__(self, config = None) :
+        self.config = config or {}
+        self.context_tokens = self.config.get("context_tokens", 32768)
+        self.reserve_tokens = self.config.get("reserve_tokens", 4096)
+        self.quotas = {**DEFAULT_QUOTAS, **self.config.get("quotas", {})}
+        self.sections : List[PromptSection] = []
+        self.stats = {}
+
+    def get_budget(self) -> int :
+        return max(0, self.context_tokens - self.reserve_tokens)
+
+    def add_section(self, name : str, items : List[Any], priority : int = 0, **kwargs) -> None :
+        kwargs.setdefault("quota", self.quotas.get(name, 0.0))
+        self.sections.append(PromptSection(name, items, priority, **kwargs))
+
+    def get_names(self) -> List[str] :
+        return [section.name for section in self.sections]
+
+    def _allocate(self) -> Dict[str, int] :
+        allowances = {section.name : section.tokens for section in self.sections if section.fixed}
+        budget = max(0, self.get_budget() - sum(allowances.values()))
+        sections = [section for section in self.sections if not section.fixed]
+        for section in sections :
+            allowances[section.name] = min(section.tokens, int(section.quota * budget))
+
+        # Quotas adding up to more than the budget are cut from the lowest priority sections first
+        over = sum(allowances[section.name] for section in sections) - budget
+        for section in sorted(sections, key = lambda section : section.priority, reverse = True) :
+            if over <= 0 :
+                break
+            cut = min(over, allowances[section.name])
+            allowances[section.name] -= cut
+            over -= cut
+
+        left = budget - sum(allowances[section.name] for section in sections)
+        for section in sorted(sections, key = lambda section : section.priority) :
+            extra = min(max(0, left), section.tokens - allowances[section.name])
+            allowances[section.name] += extra
+            left -= extra
+        return allowances
+
+    @staticmethod
+    def _cut_item(section : PromptSection, item : Any, allowance : int) -> Any :
+        """The item with its text cut to fit the allowance, truncation marker included, or None if it cannot be cut"""
+        text = item.get("content") if isinstance(item, dict) else item
+        if not isinstance(text, str) :
+            return None
+        marker = "\n... [truncated]" if section.keep == "head" else "[truncated] ...\n"
+        room = allowance - estimate_tokens(marker)
+        if room <= 0 :
+            return None
+        length = int(len(text) * room / max(1, estimate_tokens(text)))
+        part = lambda length : text[:length] if section.keep == "head" else text[len(text) - length:]
+        while length > 0 and estimate_tokens(part(length)) > room :
+            length -= estimate_tokens(part(length)) - room
+        if length <= 0 :
+            return None
+        text = part(length) + marker if section.keep == "head" else marker + part(length)
+        return {**item, "content" : text} if isinstance(item, dict) else text
+
+    def _fit_section(self, section : PromptSection, allowance : int) -> List[Any] :
+        if section.fixed or section.tokens <= allowance :
+            return section.items
+
+        items, item_tokens = section.items, section.item_tokens
+        if section.compact_items is not None :
+            items = section.compact_items
+            item_tokens = [estimate_tokens(section.to_text(item)) for item in items]
+
+        indices = range(len(items)) if section.keep == "head" else range(len(items) - 1, -1, -1)
+        kept, cut, used = [], {}, 0
+        for index in indices :
+            if used + item_tokens[index] <= allowance :
+                kept.append(index)
+                used += item_tokens[index]
+                continue
+            # The first item, or one the section must keep, is cut to the allowance left rather than dropped
+            if len(kept) < max(1, section.min_items) :
+                item = self._cut_item(section, items[index], allowance - used)
+                if item is not None :
+                    cut[index] = item
+                    kept.append(index)
+                    used += estimate_tokens(section.to_text(item))
+                    continue
+                if len(kept) < section.min_items :
+                    kept.append(index)
+                    used += item_tokens[index]
+                    continue
+            break
+        return [cut.get(index, items[index]) for index in sorted(kept)]
+
+    def build(self) -> Dict[str, List[Any]] :
+        """Fit every section to its allowance, returning the items kept for each section by name"""
+        allowances = self._allocate()
+        fitted, self.stats = {}, {"budget" : self.get_budget(), "sections" : {}}
+        for section in self.sections :
+            fitted[section.name] = self._fit_section(section, allowances[section.name])
+            self.stats["sections"][section.name] = {
+                "tokens" : section.tokens,
+                "allowance" : allowances[section.name],
+                "used" : sum(estimate_tokens(section.to_text(item)) for item in fitted[section.name]),
+                "omitted" : max(0, len(section.items) - len(fitted[section.name])),
+            }
+        self.stats["used"] = sum(info["used"] for info in self.stats["sections"].values())
+        return fitted
+
+    def get_omitted(self, name : str) -> int :
+        return self.stats.get("sections", {}).get(name, {}).get("omitted", 0)
+
+    def get_stats(self) -> Dict[str, Any] :
+        return self.stats
+
+class ConversationCompactor :
+    """
+    Keeps the replayed conversation short: the last 'keep_turns' turns are kept, older turns are
+    folded into a running summary computed in the background, and in turns before the current one
+    thoughts are dropped and large tool or memory operation results are cut to a stub.
+    """
+
+    RESULT_PREFIXES = ["[Tool Called]", "[Memory Operation Called]"]
+
+    def __init__(self, provider = None, config = None) :
+        self.provider = provider
+        self.config = config or {}
+        self.enabled = self.config.get("enabled", True)
+        self.keep_turns = self.config.get("keep_turns", 4)
+        self.batch_turns = self.config.get("batch_turns", 2)
+        self.max_result_chars = self.config.get("max_result_chars", 1000)
+        self.summary = ""
+        self.pending = None
+
+    @staticmethod
+    def get_turn_starts(messages : List[Dict]) -> List[int] :
+        return [index for index, msg in enumerate(messages) if msg["role"] == "user"]
+
+    def apply(self, messages : List[Dict]) -> List[Dict] :
+        """Take in a finished background summary, returning the messages without the turns it covers"""
+        if self.pending is None or not self.pending.done() :
+            return messages
+        task, self.pending = self.pending, None
+        try :
+            summary, count = task.result()
+        except Exception as e :
+            add_log(f"Error summarizing conversation: {e}", label = "warning")
+            return messages
+        if not summary :
+            return messages
+        self.summary = summary.strip()
+        add_log(f"Folded {count} messages into the conversation summary")
+        return messages[count:]
+
+    def schedule(self, messages : List[Dict]) -> None :
+        """Start summarizing the turns beyond 'keep_turns' once 'batch_turns' of them have piled up"""
+        if not self.enabled or self.provider is None or self.pending is not None :
+            return
+        turn_starts = self.get_turn_starts(messages)
+        if len(turn_starts) < self.keep_turns + self.batch_turns :
+            return
+        count = turn_starts[-self.keep_turns] if self.keep_turns > 0 else len(messages)
+        self.pending = asyncio.ensure_future(self._summarize(messages[:count], self.summary))
+
+    async def _summarize(self, messages : List[Dict], summary : str) -> Tuple[Optional[str], int] :
+        prompt_parts = [
+            "Update the summary of a conversation between a user and an AI assistant with the messages below.",
+            "Keep the user's goals, decisions, facts and results that may matter later, and leave out the assistant's reasoning.",
+            "Answer with the updated summary only, in less than 300 words.",
+            f"\nCurrent Summary: {summary or 'None'}",
+            "\nMessages:",
+        ]
+        for msg in self.get_compacted(messages) :
+            prompt_parts.append(f"{msg['role'].upper()}: {msg['content']}")
+        summary = await self.provider.generate_response("\n".join(prompt_parts), use_cache = True, priority = PRIORITY_BACKGROUND)
+        return summary, len(messages)
+
+    def _compact_message(self, msg : Dict) -> Optional[Dict] :
+        content = msg["content"]
+        if msg["role"] == "assistant" and content.startswith("[Think]") :
+            return None
+        if any(content.startswith(prefix) for prefix in self.RESULT_PREFIXES) and len(content) > self.max_result_chars :
+            content = content[:self.max_result_chars] + f"... [{len(content) - self.max_result_chars} chars omitted]"
+        return {"role" : msg["role"], "content" : content}
+
+    def get_compacted(self, messages : List[Dict]) -> List[Dict] :
+        return [compacted for compacted in map(self._compact_message, messages) if compacted is not None]
+
+    def get_history(self, messages : List[Dict]) -> List[Dict] :
+        """The conversation to replay: the summary, the earlier turns compacted and the current turn as is"""
+        if not self.enabled :
+            return messages
+        turn_starts = self.get_turn_starts(messages)
+        current = turn_starts[-1] if len(turn_starts) > 0 else 0
+        history = self.get_compacted(messages[:current]) + messages[current:]
+        if len(self.summary) > 0 :
+            history.insert(0, {"role" : "user", "content" : f"[Summary of the earlier conversation]\n{self.summary}"})
+        return history
+
+    async def close(self) -> None :
+        if self.pending is not None :
+            self.pending.cancel()
+            await asyncio.gather(self.pending, return_exceptions = True)
+            self.pending = None
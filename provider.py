@@ -1,6 +1,8 @@
-
-import os, aiohttp
-from typing import Optional, Dict, List, Any
+import os, re, json, math, time, random, hashlib, heapq, itertools, asyncio, aiohttp
+import contextlib, contextvars, email.utils
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict
+from typing import Optional, Dict, List, Tuple, Any, AsyncIterator, Iterator, Union
 from abc import ABC, abstractmethod
 from urllib.parse import quote 
 
@@ -20,68 +22,840 @@ def get_provider(provider_name = "Pollinations") :
         cls = GeminiProvider
     elif provider_name in ["Open", "Doubao", "Qwen", "GLM", "OpenRouter", ] :
         cls = OpenProvider
+    elif provider_name == "Chain" :
+        cls = ProviderChain
+    elif provider_name == "Mock" :
+        cls = MockProvider
     return cls
 
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# A prompt is either a plain string, sent as a single user message, or a chat prompt
+# {"system" : [{"text" : ..., "cache" : bool}], "messages" : [{"role" : "user" | "assistant", "content" : ..., "cache" : bool}]}
+# where 'cache' marks the end of a prefix that stays the same between calls and can be cached by the provider.
+# A chat prompt may also carry an "output_schema", the JSON schema the response has to follow.
+Prompt = Union[str, Dict[str, List[Dict]]]
+
+class ProviderError(Exception) :
+    """Raised when a provider API answers with a non-200 status"""
+
+    def __init__(self, message : str, status : int = None, retry_after : float = None) :
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def classify_error(error : Exception) -> str :
+    """Map a provider call failure to the error class used by retry policies"""
+    if isinstance(error, ProviderError) :
+        if error.status == 429 :
+            return "rate_limit"
+        if error.status is not None and error.status >= 500 :
+            return "server"
+        return "client"
+    if isinstance(error, asyncio.TimeoutError) :
+        return "timeout"
+    if isinstance(error, aiohttp.ClientError) :
+        return "connection"
+    return "unknown"
+
+RETRY_ERROR_CLASSES = {"rate_limit" : 2, "server" : 2, "timeout" : 1, "connection" : 2, "client" : 0, "unknown" : 0}
+
+def parse_retry_after(value) -> Optional[float] :
+    """Parse a Retry-After header given either in seconds or as an HTTP date"""
+    if value is None :
+        return None
+    try :
+        return max(0.0, float(value))
+    except ValueError :
+        pass
+    try :
+        retry_time = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_time.timestamp() - time.time())
+    except Exception :
+        return None
+
+class RequestScheduler :
+    """
+    Admits requests to one provider backend in priority order, limited by a
+    token bucket (requests per minute) and a maximum number of requests in flight.
+    """
+
+    def __init__(self, config = None) :
+        self.config = config or {}
+        self.rate = self.config.get("requests_per_minute", 0) / 60.0
+        self.capacity = max(1, self.config.get("burst", 1))
+        self.tokens = float(self.capacity)
+        self.max_in_flight = self.config.get("max_in_flight", 8)
+        self.in_flight = 0
+        self.queue = []
+        self.counter = itertools.count()
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.timer = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority : int = PRIORITY_INTERACTIVE) :
+        """Wait for a request slot; lower priority values are admitted first"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.counter), future))
+        self._dispatch()
+        try :
+            await future
+        except asyncio.CancelledError :
+            if future.done() and not future.cancelled() :
+                self._release()
+            raise
+        try :
+            yield
+        finally :
+            self._release()
+
+    def pause(self, seconds : float) -> None :
+        """Stop admitting requests for 'seconds', e.g. after a 429 with Retry-After"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def _release(self) -> None :
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _refill(self, now) -> None :
+        if self.rate > 0 :
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        else :
+            self.tokens = float(self.capacity)
+        self.updated_at = now
+
+    def _dispatch(self) -> None :
+        while len(self.queue) > 0 and self.queue[0][2].done() :
+            heapq.heappop(self.queue)
+        while len(self.queue) > 0 and self.in_flight < self.max_in_flight :
+            now = time.monotonic()
+            self._refill(now)
+            wait = self.paused_until - now
+            if wait <= 0 and self.tokens < 1 :
+                wait = (1 - self.tokens) / self.rate
+            if wait > 0 :
+                if self.timer is None :
+                    self.timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                return
+            priority, _, future = heapq.heappop(self.queue)
+            if future.done() :
+                continue
+            self.tokens -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _on_timer(self) -> None :
+        self.timer = None
+        self._dispatch()
+
+    def get_stats(self) -> Dict[str, Any] :
+        return {
+            "in_flight" : self.in_flight,
+            "queued" : len([item for item in self.queue if not item[2].done()]),
+            "paused_for" : max(0.0, self.paused_until - time.monotonic()),
+        }
+
+class CircuitBreaker :
+    """
+    Tracks consecutive failures of a provider backend. After 'failure_threshold'
+    failures the circuit opens and the backend is skipped for 'cooldown' seconds,
+    after which a single trial request is let through; the circuit closes when it
+    succeeds and opens again when it fails.
+    """
+
+    def __init__(self, config = None) :
+        self.config = config or {}
+        self.failure_threshold = self.config.get("failure_threshold", 3)
+        self.cooldown = self.config.get("cooldown", 30)
+        self.failures = 0
+        self.opened_at = None
+        self.probing_at = None
+
+    def get_state(self) -> str :
+        if self.opened_at is None :
+            return "closed"
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown :
+            return "open"
+        # A trial request that never reported back, e.g. because it was cancelled, is given up after another cooldown
+        if self.probing_at is not None and now - self.probing_at < self.cooldown :
+            return "open"
+        return "half_open"
+
+    def is_available(self) -> bool :
+        """Whether a request may be sent, claiming the trial request when the circuit is half-open"""
+        state = self.get_state()
+        if state == "half_open" :
+            self.probing_at = time.monotonic()
+        return state != "open"
+
+    def record_success(self) -> None :
+        self.failures = 0
+        self.opened_at = None
+        self.probing_at = None
+
+    def record_failure(self) -> None :
+        self.failures += 1
+        self.probing_at = None
+        if self.failures >= self.failure_threshold :
+            self.opened_at = time.monotonic()
+
+    def get_stats(self) -> Dict[str, Any] :
+        return {"state" : self.get_state(), "failures" : self.failures}
+
+schedulers : Dict[Tuple[str, str], RequestScheduler] = {}
+circuit_breakers : Dict[Tuple[str, str], CircuitBreaker] = {}
+
+def get_scheduler(provider_name : str, base_url : str, config : Dict = None) -> RequestScheduler :
+    """Get the scheduler shared by all providers talking to the same backend"""
+    key = (provider_name, base_url)
+    if key not in schedulers :
+        schedulers[key] = RequestScheduler(config)
+    return schedulers[key]
+
+def get_circuit_breaker(provider_name : str, base_url : str, config : Dict = None) -> CircuitBreaker :
+    """Get the circuit breaker shared by all providers talking to the same backend"""
+    key = (provider_name, base_url)
+    if key not in circuit_breakers :
+        circuit_breakers[key] = CircuitBreaker(config)
+    return circuit_breakers[key]
+
+async def read_sse_events(response) -> AsyncIterator[str] :
+    """Yield the 'data' payload of each server-sent event in a streaming response"""
+    data_lines = []
+    async for raw_line in response.content :
+        line = raw_line.decode("utf-8").rstrip("\r\n")
+        if len(line) < 1 :
+            if len(data_lines) > 0 :
+                yield "\n".join(data_lines)
+                data_lines = []
+        elif line.startswith("data:") :
+            data_lines.append(line[5:].strip())
+    if len(data_lines) > 0 :
+        yield "\n".join(data_lines)
+
+async def read_ndjson_lines(response) -> AsyncIterator[Dict] :
+    """Yield each JSON object in a newline-delimited JSON streaming response"""
+    async for raw_line in response.content :
+        line = raw_line.decode("utf-8").strip()
+        if len(line) > 0 :
+            yield json.loads(line)
+
+def is_chat_prompt(prompt : Prompt) -> bool :
+    return isinstance(prompt, Dict)
+
+def get_prompt_parts(prompt : Prompt) -> Tuple[List[Dict], List[Dict]] :
+    """Split a prompt into its system blocks and role-tagged messages"""
+    if not is_chat_prompt(prompt) :
+        return [], [{"role" : "user", "content" : prompt}]
+    return prompt.get("system", []), prompt.get("messages", [])
+
+def get_system_text(prompt : Prompt) -> str :
+    system_blocks, _ = get_prompt_parts(prompt)
+    return "\n".join(block["text"] for block in system_blocks)
+
+def get_prompt_cache_key(prompt : Prompt) -> Optional[str] :
+    """Hash of the system blocks up to the last cacheable one, None if nothing is marked cacheable"""
+    system_blocks, _ = get_prompt_parts(prompt)
+    cached_blocks = [index for index, block in enumerate(system_blocks) if block.get("cache", False)]
+    if len(cached_blocks) < 1 :
+        return None
+    prefix = "\n".join(block["text"] for block in system_blocks[:cached_blocks[-1] + 1])
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]
+
+def get_output_schema(prompt : Prompt) -> Optional[Dict] :
+    """The JSON schema the response has to follow, None for free-text responses"""
+    return prompt.get("output_schema", None) if is_chat_prompt(prompt) else None
+
+def flatten_prompt(prompt : Prompt) -> str :
+    """Render a chat prompt as a single string for APIs that only take plain text"""
+    if not is_chat_prompt(prompt) :
+        return prompt
+    system_blocks, messages = get_prompt_parts(prompt)
+    prompt_parts = [block["text"] for block in system_blocks]
+    for message in messages :
+        prompt_parts.append(f"{message['role'].upper()}: {message['content']}")
+    return "\n".join(prompt_parts)
+
+def to_text_part(item : Dict, use_cache_control : bool = True) -> Dict :
+    """Render a system block or message as a text part, with an ephemeral 'cache_control' marker if it is cacheable"""
+    part = {"type" : "text", "text" : item.get("text", item.get("content", ""))}
+    if use_cache_control and item.get("cache", False) :
+        part["cache_control"] = {"type" : "ephemeral"}
+    return part
+
+def to_cache_control_content(item : Dict, use_cache_control : bool = True) -> Union[str, List[Dict]] :
+    """Message content as plain text, or as a single text part when it carries a 'cache_control' marker"""
+    part = to_text_part(item, use_cache_control)
+    return [part] if "cache_control" in part else part["text"]
+
+@dataclass
+class LLMResult :
+    """Text and accounting of a single LLM call"""
+    text : Optional[str]
+    provider : str = ""
+    model : str = ""
+    prompt_tokens : int = 0
+    completion_tokens : int = 0
+    cached_tokens : int = 0
+    latency : float = 0.0
+    time_to_first_byte : Optional[float] = None
+    from_cache : bool = False
+
+    def to_dict(self) -> Dict[str, Any] :
+        return {key : value for key, value in asdict(self).items() if key != "text"}
+
+class UsageCounters :
+    """Token and latency counters over all LLM calls of the process, in total and per model"""
+
+    KEYS = ["calls", "cache_hits", "prompt_tokens", "completion_tokens", "cached_tokens", "latency"]
+
+    def __init__(self) :
+        self.totals = {key : 0 for key in self.KEYS}
+        self.models = {}
+
+    def record(self, result : LLMResult) -> None :
+        model_key = f"{result.provider}/{result.model}"
+        if model_key not in self.models :
+            self.models[model_key] = {key : 0 for key in self.KEYS}
+        for counters in [self.totals, self.models[model_key]] :
+            counters["calls"] += 1
+            counters["cache_hits"] += int(result.from_cache)
+            counters["prompt_tokens"] += result.prompt_tokens
+            counters["completion_tokens"] += result.completion_tokens
+            counters["cached_tokens"] += result.cached_tokens
+            counters["latency"] += result.latency
+
+    def get_stats(self) -> Dict[str, Any] :
+        return {**self.totals, "models" : self.models}
+
+usage_counters = UsageCounters()
+# The results of the LLM calls made in the current turn, set by the client for each iteration
+llm_results = contextvars.ContextVar("llm_results", default = None)
+
+def record_llm_result(result : LLMResult) -> None :
+    usage_counters.record(result)
+    results = llm_results.get()
+    if results is not None :
+        results.append(result)
+
+def summarize_llm_results(results : List[LLMResult]) -> Dict[str, Any] :
+    """Aggregate the accounting of several LLM calls, e.g. the calls of one turn"""
+    return {
+        "calls" : len(results),
+        "cache_hits" : sum(int(result.from_cache) for result in results),
+        "prompt_tokens" : sum(result.prompt_tokens for result in results),
+        "completion_tokens" : sum(result.completion_tokens for result in results),
+        "cached_tokens" : sum(result.cached_tokens for result in results),
+        "latency" : sum(result.latency for result in results),
+        "models" : sorted(set(f"{result.provider}/{result.model}" for result in results)),
+    }
+
+class ResponseCache :
+    """Content-addressed cache of LLM responses with an in-memory LRU and an optional on-disk tier"""
+
+    def __init__(self, config = None) :
+        self.config = config or {}
+        self.enabled = self.config.get("enabled", True)
+        self.max_entries = self.config.get("max_entries", 256)
+        self.ttl = self.config.get("ttl", 3600)
+        self.disk_dir = os.path.join("data", "llm_cache") if self.config.get("disk", False) else None
+        self.entries = OrderedDict()
+        self.stats = {"memory_hits" : 0, "disk_hits" : 0, "misses" : 0}
+
+    @staticmethod
+    def make_key(*parts) -> str :
+        return hashlib.sha256(json.dumps(parts, sort_keys = True, ensure_ascii = False).encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created) -> bool :
+        return self.ttl is not None and self.ttl > 0 and time.time() - created > self.ttl
+
+    def _disk_path(self, key) -> str :
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def get(self, key : str) -> Optional[str] :
+        """Look up a cached response, returning None on a miss or an expired entry"""
+        if key in self.entries :
+            created, value = self.entries[key]
+            if not self._is_expired(created) :
+                self.entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return value
+            del self.entries[key]
+
+        if self.disk_dir is not None and os.path.isfile(self._disk_path(key)) :
+            try :
+                data = read_json(self._disk_path(key))
+                if not self._is_expired(data["created"]) :
+                    self._remember(key, data["created"], data["response"])
+                    self.stats["disk_hits"] += 1
+                    return data["response"]
+                os.remove(self._disk_path(key))
+            except Exception as e :
+                add_log(f"Error reading LLM cache entry {key}: {e}", label = "warning")
+
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key : str, value : str) -> None :
+        created = time.time()
+        self._remember(key, created, value)
+        if self.disk_dir is not None :
+            try :
+                os.makedirs(os.path.dirname(self._disk_path(key)), exist_ok = True)
+                write_json({"created" : created, "response" : value}, self._disk_path(key))
+            except Exception as e :
+                add_log(f"Error writing LLM cache entry {key}: {e}", label = "warning")
+
+    def _remember(self, key, created, value) -> None :
+        self.entries[key] = (created, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries :
+            self.entries.popitem(last = False)
+
+    def get_stats(self) -> Dict[str, Any] :
+        lookups = sum(self.stats.values())
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        return {
+            **self.stats,
+            "entries" : len(self.entries),
+            "hit_rate" : hits / lookups if lookups > 0 else 0.0,
+        }
+
 class LLMProvider(ABC):
     """Abstract base class for LLM providers"""
-    
+
+    # Whether the backend is made to answer in the prompt's output_schema (a JSON mode, a schema or a forced tool call)
+    STRUCTURED_OUTPUT = False
+
+    def __init__(self, config = None):
+        self.config = config or {}
+        self.model = self.config.get("model", "")
+        self.session = None
+        self.cache = ResponseCache(self.config.get("cache", {}))
+        self.latency_samples = {"response" : deque(maxlen = 200), "first_delta" : deque(maxlen = 200)}
+
+        self.hedge_provider = None
+        hedge_provider_config = self.config.get("hedge", {}).get("provider", None)
+        if hedge_provider_config is not None :
+            hedge_provider_cls = get_provider(hedge_provider_config.get("name", None))
+            if hedge_provider_cls is not None :
+                self.hedge_provider = hedge_provider_cls(hedge_provider_config)
+            else :
+                add_log(f"Unknown hedge provider: {hedge_provider_config.get('name', None)}", label = "error")
+
+    def get_session(self) -> aiohttp.ClientSession :
+        """Get the shared keep-alive session, creating its connection pool on first use"""
+        if self.session is None or self.session.closed :
+            connection_config = self.config.get("connection", {})
+            connector = aiohttp.TCPConnector(
+                limit = connection_config.get("pool_size", 10),
+                limit_per_host = connection_config.get("pool_size_per_host", 0),
+                ttl_dns_cache = connection_config.get("dns_cache_ttl", 300),
+                keepalive_timeout = connection_config.get("keepalive_timeout", 30),
+            )
+            # aiohttp's own defaults, so that a hung upstream fails the call rather than blocking it
+            timeout = aiohttp.ClientTimeout(total = connection_config.get("timeout", 300), sock_connect = connection_config.get("connect_timeout", 30))
+            self.session = aiohttp.ClientSession(connector = connector, timeout = timeout)
+        return self.session
+
+    async def close(self) -> None :
+        """Close the shared session and release pooled connections"""
+        if self.session is not None and not self.session.closed :
+            await self.session.close()
+        self.session = None
+        if self.hedge_provider is not None :
+            await self.hedge_provider.close()
+
+    def supports_structured_output(self) -> bool :
+        """Whether answers are bare JSON following the prompt's output_schema, whichever of the hedged requests answers"""
+        if self.hedge_provider is not None and not self.hedge_provider.supports_structured_output() :
+            return False
+        return self.STRUCTURED_OUTPUT
+
+    def get_metrics(self) -> Dict[str, Any] :
+        """Backend specific performance metrics, empty for providers that report none"""
+        return {}
+
+    def record_latency(self, kind : str, seconds : float) -> None :
+        self.latency_samples[kind].append(seconds)
+
+    def get_hedge_delay(self, kind : str = "response") -> float :
+        """The configured percentile of observed latency, after which a hedged request is sent"""
+        hedge_config = self.config.get("hedge", {})
+        samples = sorted(self.latency_samples[kind])
+        if len(samples) < hedge_config.get("min_samples", 10) :
+            return hedge_config.get("initial_delay", 5.0)
+        index = min(len(samples) - 1, int(len(samples) * hedge_config.get("percentile", 95) / 100))
+        return max(hedge_config.get("min_delay", 0.5), samples[index])
+
+    def error_from_response(self, response) -> ProviderError :
+        """Log a non-200 provider response and wrap it as a ProviderError"""
+        add_log(f"Invalid provider response: {response}", "error")
+        if response.status == 400:
+            config = {key : self.config[key] for key in ["name", "model", "base_url", "env_name"] if key in self.config}
+            add_log(f"Check the model name and other configs: {config}", "error")
+        return ProviderError(
+            f"{self.config.get('name', 'Provider')} responded with status {response.status}",
+            status = response.status,
+            retry_after = parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+    def get_scheduler(self) -> RequestScheduler :
+        return get_scheduler(self.config.get("name", ""), getattr(self, "base_url", ""), self.config.get("rate_limit", {}))
+
+    def get_circuit_breaker(self) -> CircuitBreaker :
+        return get_circuit_breaker(self.config.get("name", ""), getattr(self, "base_url", ""), self.config.get("circuit_breaker", {}))
+
+    async def _wait_before_retry(self, error : Exception, attempt : int) -> bool :
+        """
+        Apply the retry policy for the class of 'error'; returns whether the request should be retried.
+        Rate-limited backends are paused in the scheduler for their Retry-After, other errors
+        back off exponentially with full jitter.
+        """
+        error_class = classify_error(error)
+        retry_config = self.config.get("retry", {})
+        max_retries = retry_config.get(error_class, {}).get("max_retries", RETRY_ERROR_CLASSES.get(error_class, 0))
+        if error_class == "rate_limit" :
+            max_retries = retry_config.get(error_class, {}).get("max_retries", self.config.get("rate_limit", {}).get("max_retries", max_retries))
+        if attempt >= max_retries :
+            return False
+
+        if error_class == "rate_limit" :
+            retry_after = error.retry_after
+            if retry_after is None :
+                retry_after = self.config.get("rate_limit", {}).get("default_retry_after", 5) * (2 ** attempt)
+            add_log(f"Provider {self.config.get('name', '')} is rate limited, retrying in {retry_after:.1f}s", label = "warning")
+            self.get_scheduler().pause(retry_after)
+        else :
+            base_delay = retry_config.get("base_delay", 0.5)
+            max_delay = retry_config.get("max_delay", 8)
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            add_log(f"Provider {self.config.get('name', '')} failed with {error_class} error ({error}), retrying in {delay:.1f}s", label = "warning")
+            await asyncio.sleep(delay)
+        return True
+
+    def make_result(self, text : Optional[str], prompt_tokens : int = 0, completion_tokens : int = 0, cached_tokens : int = 0, time_to_first_byte : float = None) -> LLMResult :
+        return LLMResult(
+            text, provider = self.config.get("name", ""), model = self.model,
+            prompt_tokens = prompt_tokens or 0, completion_tokens = completion_tokens or 0, cached_tokens = cached_tokens or 0,
+            time_to_first_byte = time_to_first_byte,
+        )
+
+    async def generate(self, prompt : Prompt, use_cache : bool = False, priority : int = PRIORITY_INTERACTIVE) -> Optional[LLMResult] :
+        """
+        Generate a response from the LLM, returning its text with token usage and timings, or None on failure.
+        With 'use_cache', identical prompts to the same provider and model are served from the response cache.
+        Requests wait for the backend's scheduler, where a lower 'priority' value is admitted first.
+        """
+        key = None
+        if use_cache and self.cache.enabled :
+            key = self.cache.make_key(self.config.get("name", ""), self.model, prompt)
+            cached_response = self.cache.get(key)
+            if cached_response is not None :
+                result = self.make_result(cached_response)
+                result.from_cache = True
+                record_llm_result(result)
+                return result
+
+        scheduler, breaker = self.get_scheduler(), self.get_circuit_breaker()
+        result, attempt = None, 0
+        start_time = time.monotonic()
+        while True :
+            try :
+                async with scheduler.slot(priority) :
+                    result = await self._generate_response(prompt)
+                break
+            except (ProviderError, aiohttp.ClientError, asyncio.TimeoutError) as e :
+                if not await self._wait_before_retry(e, attempt) :
+                    add_log(f"Error generating response: {e}", label = "error")
+                    break
+                attempt += 1
+
+        if isinstance(result, str) :
+            result = self.make_result(result)
+        if result is None or result.text is None :
+            breaker.record_failure()
+            return None
+
+        breaker.record_success()
+        result.latency = time.monotonic() - start_time
+        self.record_latency("response", result.latency)
+        record_llm_result(result)
+
+        if key is not None and result.text :
+            self.cache.set(key, result.text)
+        return result
+
+    async def generate_response(self, prompt : Prompt, use_cache : bool = False, priority : int = PRIORITY_INTERACTIVE) -> str :
+        """Generate a response from the LLM, returning only its text"""
+        result = await self.generate(prompt, use_cache = use_cache, priority = priority)
+        return result.text if result is not None else None
+
     @abstractmethod
-    async def generate_response(self, prompt: str) -> str :
-        """Generate a response from the LLM"""
+    async def _generate_response(self, prompt : Prompt) -> Union[str, LLMResult] :
+        """Request a response from the LLM API, as text or as a result with token usage"""
         return ""
-    
+
+    async def stream_response(self, prompt : Prompt, priority : int = PRIORITY_INTERACTIVE) -> AsyncIterator[str] :
+        """
+        Stream the response as text deltas, holding a scheduler slot while streaming.
+        Failures are only retried before the first delta has been yielded.
+        """
+        scheduler, breaker = self.get_scheduler(), self.get_circuit_breaker()
+        attempt, streamed = 0, False
+        result = self.make_result("")
+        start_time = time.monotonic()
+        while True :
+            try :
+                async with scheduler.slot(priority) :
+                    async for delta in self._stream_response(prompt) :
+                        # Providers report the token usage of a stream as a result after the last delta
+                        if isinstance(delta, LLMResult) :
+                            result.prompt_tokens, result.completion_tokens, result.cached_tokens = delta.prompt_tokens, delta.completion_tokens, delta.cached_tokens
+                            continue
+                        if not streamed :
+                            result.time_to_first_byte = time.monotonic() - start_time
+                            self.record_latency("first_delta", result.time_to_first_byte)
+                        streamed = True
+                        result.text += delta
+                        yield delta
+                breaker.record_success()
+                result.latency = time.monotonic() - start_time
+                record_llm_result(result)
+                return
+            except (ProviderError, aiohttp.ClientError, asyncio.TimeoutError) as e :
+                if streamed or not await self._wait_before_retry(e, attempt) :
+                    add_log(f"Error streaming response: {e}", label = "error")
+                    breaker.record_failure()
+                    return
+                attempt += 1
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Request a streamed response; providers without streaming yield it in one piece"""
+        result = await self._generate_response(prompt)
+        if isinstance(result, str) :
+            result = self.make_result(result)
+        if result is not None and result.text :
+            yield result.text
+            yield result
+
+    async def generate_hedged_response(self, prompt : Prompt, priority : int = PRIORITY_INTERACTIVE) -> str :
+        """
+        Generate a response, sending a duplicate request to the hedge provider if this provider
+        has not answered within the configured percentile of its latency. The first answer wins
+        and the other request is cancelled.
+        """
+        if self.hedge_provider is None :
+            return await self.generate_response(prompt, priority = priority)
+
+        primary = asyncio.ensure_future(self.generate_response(prompt, priority = priority))
+        pending = {primary}
+        try :
+            done, pending = await asyncio.wait(pending, timeout = self.get_hedge_delay("response"))
+            if primary in done and primary.result() is not None :
+                return primary.result()
+
+            add_log(f"Provider {self.config.get('name', '')} is slow, hedging with {self.hedge_provider.config.get('name', '')}")
+            pending.add(asyncio.ensure_future(self.hedge_provider.generate_response(prompt, priority = priority)))
+            while len(pending) > 0 :
+                done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                for task in done :
+                    if task.result() is not None :
+                        return task.result()
+            return None
+        finally :
+            for task in pending :
+                task.cancel()
+
+    async def stream_hedged_response(self, prompt : Prompt, priority : int = PRIORITY_INTERACTIVE) -> AsyncIterator[str] :
+        """
+        Stream a response, starting a duplicate stream from the hedge provider if no delta has
+        arrived within the configured percentile of the time to first delta. The stream that
+        yields first wins and the other one is cancelled.
+        """
+        if self.hedge_provider is None :
+            async for delta in self.stream_response(prompt, priority = priority) :
+                yield delta
+            return
+
+        streams = {self : self.stream_response(prompt, priority = priority)}
+        first_deltas = {asyncio.ensure_future(anext(streams[self], None)) : self}
+        winner, first_delta = None, None
+        try :
+            timeout = self.get_hedge_delay("first_delta")
+            while winner is None and len(first_deltas) > 0 :
+                done, _ = await asyncio.wait(first_deltas.keys(), timeout = timeout, return_when = asyncio.FIRST_COMPLETED)
+                for task in done :
+                    provider = first_deltas.pop(task)
+                    if task.exception() is None and task.result() is not None :
+                        winner, first_delta = provider, task.result()
+                        break
+                if winner is None and self.hedge_provider not in streams :
+                    add_log(f"Provider {self.config.get('name', '')} is slow, hedging with {self.hedge_provider.config.get('name', '')}")
+                    streams[self.hedge_provider] = self.hedge_provider.stream_response(prompt, priority = priority)
+                    first_deltas[asyncio.ensure_future(anext(streams[self.hedge_provider], None))] = self.hedge_provider
+                    timeout = None
+        finally :
+            for task in first_deltas.keys() :
+                task.cancel()
+            await asyncio.gather(*first_deltas.keys(), return_exceptions = True)
+            for provider, stream in streams.items() :
+                if provider is not winner :
+                    await stream.aclose()
+
+        if winner is not None :
+            yield first_delta
+            async for delta in streams[winner] :
+                yield delta
+
 class PollinationsProvider(LLMProvider):
     """Pollinations AI provider implementation"""
-    
+
     def __init__(self, config = None):
-        self.config = config
+        super().__init__(config)
         self.base_url = "https://text.pollinations.ai"
-    
-    async def generate_response(self, prompt : str) -> str :
+
+    async def _generate_response(self, prompt : Prompt) -> str :
         """Generate response using Pollinations AI"""
-        async with aiohttp.ClientSession() as session:
-            url = f"{self.base_url}/{quote(prompt)}"
-            async with session.get(url) as response:
-                text_response = await response.text()
-                return text_response
+        session = self.get_session()
+        url = f"{self.base_url}/{quote(flatten_prompt(prompt))}"
+        request_start = time.monotonic()
+        async with session.get(url) as response:
+            time_to_first_byte = time.monotonic() - request_start
+            if response.status != 200 :
+                raise self.error_from_response(response)
+            text_response = await response.text()
+            return self.make_result(text_response, time_to_first_byte = time_to_first_byte)
 
 class OllamaProvider(LLMProvider):
     """Implementation for Provider with OpenAI compatible API"""
-    
+
+    STRUCTURED_OUTPUT = True
+    TIMING_KEYS = ["total_duration", "load_duration", "prompt_eval_duration", "eval_duration"]
+    COUNT_KEYS = ["prompt_eval_count", "eval_count"]
+
     def __init__(self, config = None):
-        self.config = config
+        super().__init__(config)
         self.base_url = self.config.get("base_url", "http://127.0.0.1:11434") 
         self.model = self.config.get("model", "llama3.2") 
+        self.keep_alive = self.config.get("keep_alive", "30m")
+        self.reuse_context = self.config.get("reuse_context", False)
+        # Prompt plus response text -> the 'context' tokens api/generate returned for it
+        self.contexts = OrderedDict()
+        self.max_contexts = self.config.get("max_contexts", 8)
+        self.metrics = {"calls" : 0, "reused_context_calls" : 0, **{key : 0 for key in self.TIMING_KEYS + self.COUNT_KEYS}}
+        self.last_metrics = {}
 
-    async def generate_response(self, prompt : str) -> str :
-        """Generate response using Pollinations AI"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Content-Type": "application/json",
-            }
-
-            payload = {
-                "model" : self.model, 
-                "prompt" : prompt, 
-                "stream" : False,
-            }
-
-            async with session.post(robust_urljoin(self.base_url, "api/generate"), headers=headers, json=payload) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    return  response_data.get("response", "")
-                else :
-                    add_log(f"Invalid provider response: {response}", "error")
-                    if response.status == 400:
-                        config = {key : self.config[key] for key in ["name", "model", "base_url", "env_name"] if key in self.config}
-                        add_log(f"Check the model name and other configs: {config}", "error")
+    def _find_context(self, prompt : str) -> Tuple[Optional[List[int]], str] :
+        """Find the context of an earlier call the prompt continues, and the part of the prompt after it"""
+        for text in reversed(self.contexts.keys()) :
+            if len(prompt) > len(text) and prompt.startswith(text) :
+                self.contexts.move_to_end(text)
+                return self.contexts[text], prompt[len(text):]
+        return None, prompt
+
+    def _record_response(self, prompt : Prompt, text_response : str, response_data : Dict) -> None :
+        """Keep the returned context for continuing calls and accumulate the timings of the final response"""
+        if self.reuse_context and not is_chat_prompt(prompt) and response_data.get("context") :
+            self.contexts[prompt + text_response] = response_data["context"]
+            while len(self.contexts) > self.max_contexts :
+                self.contexts.popitem(last = False)
+
+        # Ollama reports durations in nanoseconds
+        self.last_metrics = {key : response_data.get(key, 0) / 1e9 for key in self.TIMING_KEYS}
+        self.last_metrics.update({key : response_data.get(key, 0) for key in self.COUNT_KEYS})
+        self.metrics["calls"] += 1
+        for key, value in self.last_metrics.items() :
+            self.metrics[key] += value
+        add_log(f"Ollama timings: {self.last_metrics}", label = "log", print = False)
+
+    def get_metrics(self) -> Dict[str, Any] :
+        return {**self.metrics, "last" : self.last_metrics, "keep_alive" : self.keep_alive}
+
+    def _build_request(self, prompt : Prompt, stream : bool = False) -> Tuple[str, Dict, Dict] :
+        headers = {
+            "Content-Type": "application/json",
+        }
+
+        payload = {
+            "model" : self.model, 
+            "stream" : stream,
+        }
+
+        # Keep the model loaded between calls instead of reloading it after Ollama's default 5 minutes
+        if self.keep_alive is not None :
+            payload["keep_alive"] = self.keep_alive
+
+        if self.config.get("max_tokens", None) is not None :
+            payload["options"] = {"num_predict" : self.config["max_tokens"]}
+
+        # Ollama constrains the output to the given schema, or to any JSON with "json"
+        if get_output_schema(prompt) is not None :
+            payload["format"] = get_output_schema(prompt) if self.config.get("json_schema", True) else "json"
+
+        if not is_chat_prompt(prompt) :
+            context, prompt_text = self._find_context(prompt) if self.reuse_context else (None, prompt)
+            payload["prompt"] = prompt_text
+            if context is not None :
+                payload["context"] = context
+                self.metrics["reused_context_calls"] += 1
+            return robust_urljoin(self.base_url, "api/generate"), headers, payload
+
+        # Ollama keeps the KV cache of the loaded model, so the messages a conversation shares
+        # with the previous call are only evaluated once
+        system_text, (_, messages) = get_system_text(prompt), get_prompt_parts(prompt)
+        payload["messages"] = ([{"role" : "system", "content" : system_text}] if len(system_text) > 0 else []) + [
+            {"role" : message["role"], "content" : message["content"]} for message in messages
+        ]
+        return robust_urljoin(self.base_url, "api/chat"), headers, payload
+
+    async def _generate_response(self, prompt : Prompt) -> LLMResult :
+        """Generate response using Ollama"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt)
+        # Time until the response headers arrive, measured from when this request is sent
+        request_start = time.monotonic()
+        async with session.post(url, headers=headers, json=payload) as response:
+            time_to_first_byte = time.monotonic() - request_start
+            if response.status == 200:
+                response_data = await response.json()
+                text_response = response_data.get("response") or response_data.get("message", {}).get("content", "")
+                self._record_response(prompt, text_response, response_data)
+                return self.make_result(text_response, response_data.get("prompt_eval_count"), response_data.get("eval_count"), time_to_first_byte = time_to_first_byte)
+            else :
+                raise self.error_from_response(response)
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Stream response from Ollama's NDJSON output"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt, stream = True)
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status == 200:
+                text_response = ""
+                async for chunk in read_ndjson_lines(response) :
+                    content = chunk.get("response") or chunk.get("message", {}).get("content")
+                    if content :
+                        text_response += content
+                        yield content
+                    if chunk.get("done", False) :
+                        self._record_response(prompt, text_response, chunk)
+                        yield self.make_result("", chunk.get("prompt_eval_count"), chunk.get("eval_count"))
+                        break
+            else :
+                raise self.error_from_response(response)
 
 
 class OpenProvider(LLMProvider):
     """Implementation for Provider with OpenAI compatible API"""
-    
+
+    STRUCTURED_OUTPUT = True
+
     def __init__(self, config = None):
-        self.config = config
+        super().__init__(config)
         self.base_url = self.config.get("base_url", "") 
         self.model = self.config.get("model", "") 
         self.api_key = self.config.get("api_key", "") 
@@ -102,49 +876,121 @@ class OpenProvider(LLMProvider):
 
         if len(self.api_key.strip()) < 1 and len(self.env_name.strip()) > 0 : 
             self.api_key = os.environ.get(self.env_name)
-    
-    async def generate_response(self, prompt : str) -> str :
+
+        # Turned off for the rest of the process when the backend rejects it
+        self.json_mode = self.config.get("json_mode", True)
+
+    def supports_structured_output(self) -> bool :
+        return self.json_mode and super().supports_structured_output()
+
+    async def _reject_json_mode(self, payload : Dict, response) -> bool :
+        """Whether a request failed because the backend does not take JSON mode, which is then no longer asked for"""
+        if response.status != 400 or "response_format" not in payload :
+            return False
+        # Other bad requests (e.g. a wrong model name or a context that is too long) leave JSON mode on
+        body = (await response.text()).lower()
+        if "response_format" not in body and "json" not in body :
+            return False
+        add_log(f"{self.config['name']} rejected JSON mode for {self.model}, sending free-text requests instead", label = "warning")
+        self.json_mode = False
+        return True
+
+    def _build_request(self, prompt : Prompt, stream : bool = False) -> Tuple[str, Dict, Dict] :
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+
+        # Providers such as OpenRouter and Qwen take Anthropic style 'cache_control' markers,
+        # others cache identical prefixes automatically and would reject the content parts
+        use_cache_control = self.config.get("prompt_cache", False)
+        system_blocks, messages = get_prompt_parts(prompt)
+        chat_messages = [{"role" : message["role"], "content" : to_cache_control_content(message, use_cache_control)} for message in messages]
+        if len(system_blocks) > 0 :
+            system_content = [to_text_part(block) for block in system_blocks] if use_cache_control else get_system_text(prompt)
+            chat_messages.insert(0, {"role" : "system", "content" : system_content})
+
+        payload = {
+            "model" : self.model, 
+            "messages" : chat_messages,  
+            "stream" : stream,
+        }
+
+        # JSON mode is widely supported by OpenAI compatible APIs, unlike strict JSON schemas
+        if get_output_schema(prompt) is not None and self.json_mode :
+            payload["response_format"] = {"type" : "json_object"}
+
+        if self.config["name"] == "Qwen" and self.model.startswith("qwen3") :
+            payload["enable_thinking"] = False 
+
+        if self.config["name"] == "GLM" and self.model.startswith("glm") :
+            payload["thinking"] = {"type" : "disabled"} 
+
+        if self.config.get("max_tokens", None) is not None :
+            payload["max_tokens"] = self.config["max_tokens"]
+
+        if stream and self.config.get("stream_usage", True) :
+            payload["stream_options"] = {"include_usage" : True}
+
+        return robust_urljoin(self.base_url, "chat/completions"), headers, payload
+
+    async def _generate_response(self, prompt : Prompt) -> LLMResult :
         """Generate response using OpenAI compatible provider"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            }
-
-            payload = {
-                "model" : self.model, 
-                "messages" : [{"role" : "user", "content" : prompt}],  
-                "stream" : False,
-            }
-
-            if self.config["name"] == "Qwen" and self.model.startswith("qwen3") :
-                payload["enable_thinking"] = False 
-
-            if self.config["name"] == "GLM" and self.model.startswith("glm") :
-                payload["thinking"] = {"type" : "disabled"} 
-
-            async with session.post(robust_urljoin(self.base_url, "chat/completions"), headers=headers, json=payload) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    if "choices" in response_data:
-                        message_content = response_data["choices"][0]["message"].get("content")
-                        reasoning_content = response_data["choices"][0]["message"].get("reasoning_content")
-
-                        if message_content is not None:
-                            return message_content
-                        elif reasoning_content is not None:
-                            return reasoning_content
-                else :
-                    add_log(f"Invalid provider response: {response}", "error")
-                    if response.status == 400:
-                        config = {key : self.config[key] for key in ["name", "model", "base_url", "env_name"] if key in self.config}
-                        add_log(f"Check the model name and other configs: {config}", "error")
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt)
+        # Time until the response headers arrive, measured from when this request is sent
+        request_start = time.monotonic()
+        async with session.post(url, headers=headers, json=payload) as response:
+            time_to_first_byte = time.monotonic() - request_start
+            if response.status == 200:
+                response_data = await response.json()
+                if "choices" in response_data:
+                    message_content = response_data["choices"][0]["message"].get("content")
+                    reasoning_content = response_data["choices"][0]["message"].get("reasoning_content")
+
+                    usage = response_data.get("usage") or {}
+                    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+                    if message_content is not None:
+                        return self.make_result(message_content, usage.get("prompt_tokens"), usage.get("completion_tokens"), cached_tokens, time_to_first_byte)
+                    elif reasoning_content is not None:
+                        return self.make_result(reasoning_content, usage.get("prompt_tokens"), usage.get("completion_tokens"), cached_tokens, time_to_first_byte)
+                return None
+            elif not await self._reject_json_mode(payload, response) :
+                raise self.error_from_response(response)
+        # Sent again as a free-text request
+        return await self._generate_response(prompt)
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Stream response from an OpenAI compatible provider's SSE output"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt, stream = True)
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status == 200:
+                async for data in read_sse_events(response) :
+                    if data == "[DONE]" :
+                        break
+                    chunk = json.loads(data)
+                    if len(chunk.get("choices", [])) > 0 :
+                        content = chunk["choices"][0].get("delta", {}).get("content")
+                        if content :
+                            yield content
+                    if chunk.get("usage") :
+                        usage = chunk["usage"]
+                        yield self.make_result("", usage.get("prompt_tokens"), usage.get("completion_tokens"), (usage.get("prompt_tokens_details") or {}).get("cached_tokens"))
+                return
+            elif not await self._reject_json_mode(payload, response) :
+                raise self.error_from_response(response)
+        # Sent again as a free-text request
+        async for item in self._stream_response(prompt) :
+            yield item
 
 class OpenAIProvider(LLMProvider):
     """Implementation for OpenAI API"""
-    
+
+    STRUCTURED_OUTPUT = True
+
     def __init__(self, config = None):
-        self.config = config
+        super().__init__(config)
         self.model = self.config.get("model", "") 
         self.api_key = self.config.get("api_key", "") 
         self.base_url = "https://api.openai.com/v1/"
@@ -152,38 +998,81 @@ class OpenAIProvider(LLMProvider):
 
         if len(self.api_key.strip()) < 1 : 
             self.api_key = os.environ.get(self.env_name)
-    
-    async def generate_response(self, prompt : str) -> str :
-        """Generate response using Anthropic API"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            }
-
-            payload = {
-                "model" : self.model, 
-                "input" : prompt,  
-                "stream" : False,
-            }
-
-            async with session.post(robust_urljoin(self.base_url, "responses"), headers=headers, json=payload) as response:
-                if response.status == 200:
-                    response_data = response.json()
-                    if "output" in response_data.keys() : 
-                        return response_data["output"][0]["content"][0]["text"]
-                else :
-                    add_log(f"Invalid provider response: {response}", "error")
-                    if response.status == 400:
-                        config = {key : self.config[key] for key in ["name", "model", "base_url", "env_name"] if key in self.config}
-                        add_log(f"Check the model name and other configs: {config}", "error")
+
+    def _build_request(self, prompt : Prompt, stream : bool = False) -> Tuple[str, Dict, Dict] :
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+
+        payload = {
+            "model" : self.model, 
+            "input" : prompt,  
+            "stream" : stream,
+        }
+
+        if is_chat_prompt(prompt) :
+            _, messages = get_prompt_parts(prompt)
+            payload["instructions"] = get_system_text(prompt)
+            payload["input"] = [{"role" : message["role"], "content" : message["content"]} for message in messages]
+            # OpenAI caches identical prefixes automatically, the key keeps requests sharing a prefix on the same cache
+            prompt_cache_key = get_prompt_cache_key(prompt)
+            if prompt_cache_key is not None :
+                payload["prompt_cache_key"] = prompt_cache_key
+
+        if get_output_schema(prompt) is not None :
+            payload["text"] = {"format" : {"type" : "json_schema", "name" : "output", "schema" : get_output_schema(prompt), "strict" : False}}
+
+        if self.config.get("max_tokens", None) is not None :
+            payload["max_output_tokens"] = self.config["max_tokens"]
+
+        return robust_urljoin(self.base_url, "responses"), headers, payload
+
+    async def _generate_response(self, prompt : Prompt) -> LLMResult :
+        """Generate response using OpenAI API"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt)
+        # Time until the response headers arrive, measured from when this request is sent
+        request_start = time.monotonic()
+        async with session.post(url, headers=headers, json=payload) as response:
+            time_to_first_byte = time.monotonic() - request_start
+            if response.status == 200:
+                response_data = await response.json()
+                if "output" in response_data.keys() : 
+                    usage = response_data.get("usage") or {}
+                    return self.make_result(
+                        response_data["output"][0]["content"][0]["text"],
+                        usage.get("input_tokens"), usage.get("output_tokens"), (usage.get("input_tokens_details") or {}).get("cached_tokens"), time_to_first_byte,
+                    )
+            else :
+                raise self.error_from_response(response)
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Stream response from OpenAI API's SSE output"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt, stream = True)
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status == 200:
+                async for data in read_sse_events(response) :
+                    event = json.loads(data)
+                    if event.get("type") == "response.output_text.delta" and event.get("delta") :
+                        yield event["delta"]
+                    elif event.get("type") == "response.completed" :
+                        usage = event.get("response", {}).get("usage") or {}
+                        yield self.make_result("", usage.get("input_tokens"), usage.get("output_tokens"), (usage.get("input_tokens_details") or {}).get("cached_tokens"))
+                        break
+            else :
+                raise self.error_from_response(response)
 
 
 class AnthropicProvider(LLMProvider):
     """Implementation for Anthropic API"""
-    
+
+    OUTPUT_TOOL = "respond"
+    STRUCTURED_OUTPUT = True
+
     def __init__(self, config = None):
-        self.config = config
+        super().__init__(config)
         self.model = self.config.get("model", "") 
         self.api_key = self.config.get("api_key", "") 
         self.base_url = "https://api.anthropic.com/v1/"
@@ -191,37 +1080,88 @@ class AnthropicProvider(LLMProvider):
 
         if len(self.api_key.strip()) < 1 : 
             self.api_key = os.environ.get(self.env_name)
-    
-    async def generate_response(self, prompt : str) -> str :
+
+    def make_usage_result(self, text : Optional[str], usage : Dict, time_to_first_byte : float = None) -> LLMResult :
+        # Anthropic counts cache reads and writes separately from the uncached input tokens
+        cached_tokens = usage.get("cache_read_input_tokens") or 0
+        prompt_tokens = (usage.get("input_tokens") or 0) + cached_tokens + (usage.get("cache_creation_input_tokens") or 0)
+        return self.make_result(text, prompt_tokens, usage.get("output_tokens"), cached_tokens, time_to_first_byte)
+
+    def _build_request(self, prompt : Prompt, stream : bool = False) -> Tuple[str, Dict, Dict] :
+        headers = {
+            "x-api-key": f"{self.api_key}",
+            "anthropic-version": "2023-06-01",
+            "Content-Type": "application/json",
+        }
+
+        use_cache_control = self.config.get("prompt_cache", True)
+        system_blocks, messages = get_prompt_parts(prompt)
+
+        payload = {
+            "model" : self.model, 
+            "max_tokens" : self.config.get("max_tokens", 4096),
+            "messages" : [{"role" : message["role"], "content" : to_cache_control_content(message, use_cache_control)} for message in messages],  
+            "stream" : stream,
+        }
+
+        if len(system_blocks) > 0 :
+            payload["system"] = [to_text_part(block, use_cache_control) for block in system_blocks]
+
+        # Anthropic has no JSON mode, so a structured output is requested as the input of a forced tool call
+        if get_output_schema(prompt) is not None :
+            payload["tools"] = [{"name" : self.OUTPUT_TOOL, "description" : "Send the response in the required format.", "input_schema" : get_output_schema(prompt)}]
+            payload["tool_choice"] = {"type" : "tool", "name" : self.OUTPUT_TOOL}
+        return robust_urljoin(self.base_url, "messages"), headers, payload
+
+    async def _generate_response(self, prompt : Prompt) -> LLMResult :
         """Generate response using Anthropic API"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "x-api-key": f"{self.api_key}",
-                "Content-Type": "application/json",
-            }
-
-            payload = {
-                "model" : self.model, 
-                "messages" : [{"role" : "user", "content" : prompt}],  
-                "stream" : False,
-            }
-
-            async with session.post(robust_urljoin(self.base_url, "messages"), headers=headers, json=payload) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    return response_data["content"][0]["text"]
-                else :
-                    add_log(f"Invalid provider response: {response}", "error")
-                    if response.status == 400:
-                        config = {key : self.config[key] for key in ["name", "model", "base_url", "env_name"] if key in self.config}
-                        add_log(f"Check the model name and other configs: {config}", "error")
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt)
+        # Time until the response headers arrive, measured from when this request is sent
+        request_start = time.monotonic()
+        async with session.post(url, headers=headers, json=payload) as response:
+            time_to_first_byte = time.monotonic() - request_start
+            if response.status == 200:
+                response_data = await response.json()
+                text_response = response_data["content"][0].get("text")
+                for block in response_data["content"] :
+                    if block["type"] == "tool_use" and block["name"] == self.OUTPUT_TOOL :
+                        text_response = json.dumps(block["input"], ensure_ascii = False)
+                return self.make_usage_result(text_response, response_data.get("usage") or {}, time_to_first_byte)
+            else :
+                raise self.error_from_response(response)
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Stream response from Anthropic API's SSE output"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt, stream = True)
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status == 200:
+                usage = {}
+                async for data in read_sse_events(response) :
+                    event = json.loads(data)
+                    if event.get("type") == "content_block_delta" and event["delta"].get("type") == "text_delta" :
+                        yield event["delta"]["text"]
+                    elif event.get("type") == "content_block_delta" and event["delta"].get("type") == "input_json_delta" :
+                        yield event["delta"]["partial_json"]
+                    elif event.get("type") == "message_start" :
+                        usage = event.get("message", {}).get("usage") or {}
+                    elif event.get("type") == "message_delta" :
+                        usage = {**usage, **(event.get("usage") or {})}
+                    elif event.get("type") == "message_stop" :
+                        yield self.make_usage_result("", usage)
+                        break
+            else :
+                raise self.error_from_response(response)
 
 
 class GeminiProvider(LLMProvider):
     """Implementation for Gemini API"""
-    
+
+    STRUCTURED_OUTPUT = True
+
     def __init__(self, config = None):
-        self.config = config
+        super().__init__(config)
         self.model = self.config.get("model", "") 
         self.api_key = self.config.get("api_key", "") 
         self.base_url = "https://generativelanguage.googleapis.com/v1beta"
@@ -229,29 +1169,296 @@ class GeminiProvider(LLMProvider):
 
         if len(self.api_key.strip()) < 1 : 
             self.api_key = os.environ.get(self.env_name)
-    
-    async def generate_response(self, prompt : str) -> str :
-        """Generate response using Gemini API"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Content-Type": "application/json",
-            }
 
-            payload = {
-                "contents" : {
-                    "parts" : [{"text" : prompt}], 
-                },
-            }
+    def _build_request(self, prompt : Prompt, stream : bool = False) -> Tuple[str, Dict, Dict] :
+        headers = {
+            "Content-Type": "application/json",
+        }
+
+        system_text, (_, messages) = get_system_text(prompt), get_prompt_parts(prompt)
+        payload = {
+            "contents" : [
+                {"role" : "model" if message["role"] == "assistant" else "user", "parts" : [{"text" : message["content"]}]} for message in messages
+            ],
+        }
 
+        if len(system_text) > 0 :
+            payload["systemInstruction"] = {"parts" : [{"text" : system_text}]}
+
+        generation_config = {}
+        if self.config.get("max_tokens", None) is not None :
+            generation_config["maxOutputTokens"] = self.config["max_tokens"]
+        # Gemini only takes a subset of JSON schema, so MCP tool schemas are not passed as 'responseSchema'
+        if get_output_schema(prompt) is not None :
+            generation_config["responseMimeType"] = "application/json"
+        if len(generation_config) > 0 :
+            payload["generationConfig"] = generation_config
+
+        if stream :
+            url = "%s/models/%s:streamGenerateContent?alt=sse&key=%s" % (self.base_url, self.model, self.api_key)
+        else :
             url = "%s/models/%s:generateContent?key=%s" % (self.base_url, self.model, self.api_key)
+        return url, headers, payload
+
+    async def _generate_response(self, prompt : Prompt) -> LLMResult :
+        """Generate response using Gemini API"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt)
+        # Time until the response headers arrive, measured from when this request is sent
+        request_start = time.monotonic()
+        async with session.post(url, headers=headers, json=payload) as response:
+            time_to_first_byte = time.monotonic() - request_start
+            if response.status == 200:
+                response_data = await response.json()
+                if "candidates" in response_data.keys() : 
+                    usage = response_data.get("usageMetadata") or {}
+                    return self.make_result(
+                        response_data["candidates"][0]["content"]["parts"][0]["text"],
+                        usage.get("promptTokenCount"), usage.get("candidatesTokenCount"), usage.get("cachedContentTokenCount"), time_to_first_byte,
+                    )
+            else :
+                raise self.error_from_response(response)
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Stream response from Gemini API's SSE output"""
+        session = self.get_session()
+        url, headers, payload = self._build_request(prompt, stream = True)
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status == 200:
+                usage = {}
+                async for data in read_sse_events(response) :
+                    chunk = json.loads(data)
+                    usage = chunk.get("usageMetadata") or usage
+                    for candidate in chunk.get("candidates", [])[:1] :
+                        for part in candidate.get("content", {}).get("parts", []) :
+                            if part.get("text") :
+                                yield part["text"]
+                yield self.make_result("", usage.get("promptTokenCount"), usage.get("candidatesTokenCount"), usage.get("cachedContentTokenCount"))
+            else :
+                raise self.error_from_response(response)
+
+
+class MockProvider(LLMProvider):
+    """
+    Offline provider with scripted replies, sampled latency, token throughput and injected errors,
+    for reproducible benchmarks; mock_server.py serves the same behaviour over HTTP.
+    """
+
+    STRUCTURED_OUTPUT = True
+    DEFAULT_REPLY = {"think" : "This is a mock response.", "text" : "Mock response.", "finished" : True}
+
+    def __init__(self, config = None):
+        super().__init__(config)
+        self.model = self.config.get("model", "mock")
+        self.base_url = "mock://%s" % self.model
+        self.replies = self.config.get("replies", [self.DEFAULT_REPLY])
+        self.reply_index = 0
+        self.random = random.Random(self.config.get("seed", 0))
+
+    def next_reply(self, structured : bool = False) -> str :
+        """
+        The next scripted reply, cycling through the list. Dictionaries are rendered as a fenced JSON
+        output, or as plain JSON if the prompt asks for a structured output.
+        """
+        reply = self.replies[self.reply_index % len(self.replies)]
+        self.reply_index += 1
+        if isinstance(reply, Dict) :
+            reply = json.dumps(reply, ensure_ascii = False)
+            if not structured :
+                reply = "```\n%s\n```" % reply
+        return reply
+
+    def sample_latency(self) -> float :
+        """Sample the time to the first token from the configured distribution"""
+        latency_config = self.config.get("latency", {})
+        distribution = latency_config.get("distribution", "fixed")
+        mean = latency_config.get("mean", 0.0)
+        if distribution == "uniform" :
+            latency = self.random.uniform(latency_config.get("min", 0.0), latency_config.get("max", 2 * mean))
+        elif distribution == "normal" :
+            latency = self.random.gauss(mean, latency_config.get("stddev", 0.0))
+        elif distribution == "lognormal" :
+            # The mean of a lognormal distribution is exp(mu + sigma^2 / 2)
+            sigma = latency_config.get("sigma", 0.5)
+            latency = self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean > 0 else 0.0
+        else :
+            latency = mean
+        return max(0.0, latency)
+
+    def sample_error(self) -> Optional[int] :
+        """The HTTP status of an injected failure, or None if the call should succeed"""
+        if self.random.random() < self.config.get("error_rate", 0.0) :
+            return self.config.get("error_status", 500)
+        return None
+
+    def split_tokens(self, text : str) -> List[str] :
+        """Split a reply into word sized chunks streamed as tokens"""
+        return re.findall(r"\s*\S+", text) or [text]
+
+    def make_mock_result(self, prompt : Prompt, text_response : str, time_to_first_byte : float = None) -> LLMResult :
+        """Result with token counts estimated from the prompt size and the number of streamed tokens"""
+        return self.make_result(text_response, len(flatten_prompt(prompt)) // 4, len(self.split_tokens(text_response)), time_to_first_byte = time_to_first_byte)
+
+    def get_token_delay(self) -> float :
+        tokens_per_second = self.config.get("tokens_per_second", 0)
+        return 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+
+    async def _generate_response(self, prompt : Prompt) -> LLMResult :
+        """Generate a scripted response after the sampled latency and generation time"""
+        latency, status, text_response = self.sample_latency(), self.sample_error(), self.next_reply(get_output_schema(prompt) is not None)
+        await asyncio.sleep(latency)
+        if status is not None :
+            raise ProviderError(f"Mock responded with status {status}", status = status)
+        await asyncio.sleep(self.get_token_delay() * len(self.split_tokens(text_response)))
+        return self.make_mock_result(prompt, text_response, latency)
+
+    async def _stream_response(self, prompt : Prompt) -> AsyncIterator[Union[str, LLMResult]] :
+        """Stream a scripted response token by token at the configured throughput"""
+        latency, status, text_response = self.sample_latency(), self.sample_error(), self.next_reply(get_output_schema(prompt) is not None)
+        await asyncio.sleep(latency)
+        if status is not None :
+            raise ProviderError(f"Mock responded with status {status}", status = status)
+        for token in self.split_tokens(text_response) :
+            yield token
+            await asyncio.sleep(self.get_token_delay())
+        yield self.make_mock_result(prompt, text_response)
+
+
+class ProviderChain(LLMProvider):
+    """
+    Failover chain over several providers, tried in order. Each member applies its own
+    retry policy, and members whose circuit breaker is open are skipped until their cooldown ends.
+    """
+
+    def __init__(self, config = None):
+        super().__init__(config)
+        self.providers = []
+        for provider_config in self.config.get("providers", []) :
+            provider_cls = get_provider(provider_config.get("name", None))
+            if provider_cls is not None and provider_cls is not ProviderChain :
+                self.providers.append(provider_cls(provider_config))
+            else :
+                add_log(f"Unknown provider in chain: {provider_config.get('name', None)}", label = "error")
+        if len(self.providers) > 0 :
+            self.model = self.providers[0].model
+
+    def supports_structured_output(self) -> bool :
+        """Whether every member follows the output schema, as any of them may answer"""
+        if self.hedge_provider is not None and not self.hedge_provider.supports_structured_output() :
+            return False
+        return len(self.providers) > 0 and all(provider.supports_structured_output() for provider in self.providers)
+
+    def get_available_providers(self) -> Iterator[LLMProvider] :
+        """
+        Members with a closed (or half-open) circuit, falling back to all members if every circuit is open.
+        Circuits are checked as the members are tried, so that only a member that is called takes the
+        trial request of its half-open circuit.
+        """
+        if all(provider.get_circuit_breaker().get_state() == "open" for provider in self.providers) :
+            yield from self.providers
+            return
+        for provider in self.providers :
+            if provider.get_circuit_breaker().is_available() :
+                yield provider
+
+    async def generate(self, prompt : Prompt, use_cache : bool = False, priority : int = PRIORITY_INTERACTIVE) -> Optional[LLMResult] :
+        """Generate a response from the first healthy member that answers"""
+        start_time = time.monotonic()
+        for provider in self.get_available_providers() :
+            result = await provider.generate(prompt, use_cache = use_cache, priority = priority)
+            if result is not None :
+                self.record_latency("response", time.monotonic() - start_time)
+                return result
+            add_log(f"Provider {provider.config.get('name', '')} failed, trying the next provider in chain", label = "warning")
+        return None
+
+    async def _generate_response(self, prompt : Prompt) -> Optional[LLMResult] :
+        return await self.generate(prompt)
+
+    async def stream_response(self, prompt : Prompt, priority : int = PRIORITY_INTERACTIVE) -> AsyncIterator[str] :
+        """Stream from the first healthy member that yields any output"""
+        start_time = time.monotonic()
+        for provider in self.get_available_providers() :
+            streamed = False
+            async for delta in provider.stream_response(prompt, priority = priority) :
+                if not streamed :
+                    self.record_latency("first_delta", time.monotonic() - start_time)
+                streamed = True
+                yield delta
+            if streamed :
+                return
+            add_log(f"Provider {provider.config.get('name', '')} failed, trying the next provider in chain", label = "warning")
+
+    async def close(self) -> None :
+        await super().close()
+        for provider in self.providers :
+            await provider.close()
+
+class ProviderRouter :
+    """
+    Routes each kind of LLM call to a provider by its declared purpose.
+
+    The 'routing' config maps a purpose to a provider config (merged over the
+    default 'provider' config when it names the same provider or none, used as it
+    is otherwise), a 'model' override and limits such as 'max_tokens':
+
+        "routing" : {
+            "task_update" : {"model" : "gpt-4o-mini", "max_tokens" : 1024},
+            "file_extract" : {"provider" : {"name" : "Ollama", "model" : "llama3.2"}},
+        }
+
+    Purposes without a route fall back to the 'provider' of their legacy config
+    section ('task' or 'memory'), then to the default provider.
+    """
+
+    PURPOSES = ["react", "task_update", "file_extract", "memory_consolidate", "history_summary"]
+    LEGACY_SECTIONS = {"task_update" : "task", "file_extract" : "task", "memory_consolidate" : "memory"}
+
+    def __init__(self, configs = None) :
+        self.configs = configs or {}
+        self.default_config = self.configs.get("provider", {})
+        self.routes = self.configs.get("routing", {})
+        self.providers : Dict[str, LLMProvider] = {}
+
+    def get_provider_config(self, purpose : str) -> Dict :
+        route = self.routes.get(purpose, {})
+        fallback_config = self.configs.get(self.LEGACY_SECTIONS.get(purpose, ""), {}).get("provider", {})
+        if len(route.get("provider", {})) > 0 :
+            # Only a route to the default backend inherits its settings (base_url, api_key, ...)
+            if route["provider"].get("name", self.default_config.get("name")) == self.default_config.get("name") :
+                provider_config = {**self.default_config, **route["provider"]}
+            else :
+                provider_config = dict(route["provider"])
+        elif len(fallback_config) > 0 :
+            provider_config = dict(fallback_config)
+        else :
+            provider_config = dict(self.default_config)
+        for key in ["model", "max_tokens"] :
+            if key in route :
+                provider_config[key] = route[key]
+        return provider_config
+
+    def get_provider(self, purpose : str) -> Optional[LLMProvider] :
+        """Get the provider for 'purpose'; purposes with identical provider configs share one instance"""
+        provider_config = self.get_provider_config(purpose)
+        key = json.dumps(provider_config, sort_keys = True)
+        if key not in self.providers :
+            provider_cls = get_provider(provider_config.get("name", None))
+            if provider_cls is None :
+                add_log(f"Unknown provider for {purpose}: {provider_config.get('name', None)}", label = "error")
+                return None
+            self.providers[key] = provider_cls(provider_config)
+        provider = self.providers[key]
+        add_log(f"Using provider {provider.config.get('name', '')} ({provider.model or 'default model'}) for {purpose}")
+        return provider
+
+    def get_routes_info(self) -> Dict[str, Dict] :
+        info = {}
+        for purpose in self.PURPOSES :
+            provider_config = self.get_provider_config(purpose)
+            info[purpose] = {key : provider_config[key] for key in ["name", "model", "max_tokens"] if key in provider_config}
+        return info
 
-            async with session.post(url, headers=headers, json=payload) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    if "candidates" in response_data.keys() : 
-                        return response_data["candidates"][0]["content"]["parts"][0]["text"]
-                else :
-                    add_log(f"Invalid provider response: {response}", "error")
-                    if response.status == 400:
-                        config = {key : self.config[key] for key in ["name", "model", "base_url", "env_name"] if key in self.config}
-                        add_log(f"Check the model name and other configs: {config}", "error")
+    async def close(self) -> None :
+        for provider in self.providers.values() :
+            await provider.close()
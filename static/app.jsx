@@ -75,6 +75,7 @@ function App() {
     const [memory, setMemory] = useState(null);
     const [chatMessages, setChatMessages] = useState([]);
     const [currentQuery, setCurrentQuery] = useState('');
+    const [streamingText, setStreamingText] = useState({});
     const [tools, setTools] = useState({});
     const [memoryOps, setMemoryOps] = useState({});
     const [alert, setAlert] = useState({ isOpen: false, title: '', message: '', type: 'info' });
@@ -219,6 +220,7 @@ function App() {
         const userMessage = { role: 'user', content: currentQuery, timestamp: new Date().toISOString() };
         setChatMessages(prev => [...prev, userMessage]);
         setCurrentQuery('');
+        setStreamingText({});
         
         setLoading(true);
         setIsProcessingQuery(true);  // ** ADD THIS **
@@ -228,6 +230,7 @@ function App() {
 
         try {
             const response = await api.post('/chat', { query: currentQuery });
+            setStreamingText({});
 
             updateStatus('Response received, updating task data...', 'polling');
 
@@ -338,8 +341,29 @@ function App() {
             }
         });
 
+        // Task updates are applied in the background once the response is returned
+        socket.on('task_updated', (data) => {
+            if (data.updated_task) {
+                setTasks(prev => ({
+                    ...prev,
+                    [data.updated_task.id]: { ...prev[data.updated_task.id], ...data.updated_task }
+                }));
+                loadTaskDetails(data.updated_task.id);
+            }
+        });
+
+        // Partial response text streamed while the agent is generating
+        socket.on('chat_delta', (data) => {
+            setStreamingText(prev => ({
+                ...prev,
+                [data.iteration]: (prev[data.iteration] || '') + data.delta
+            }));
+        });
+
         return () => {
             socket.off('chat_response');
+            socket.off('task_updated');
+            socket.off('chat_delta');
         };
     }, []);
 
@@ -369,6 +393,7 @@ function App() {
                 <div className="chat-container">
                     <ChatArea
                         messages={chatMessages}
+                        streamingText={loading ? Object.keys(streamingText).sort((a, b) => a - b).map(key => streamingText[key]).join('\n\n') : ''}
                         currentQuery={currentQuery}
                         onQueryChange={setCurrentQuery}
                         onSendMessage={sendMessage}
@@ -596,7 +621,7 @@ function TaskCard({ task, isSelected, isWorking, onSelect, onLoad }) {
 }
 
 // Chat Area Component (unchanged from previous version)
-function ChatArea({ messages, currentQuery, onQueryChange, onSendMessage, onShowMemory, onShowConfig, loading, onShowDetail }) {
+function ChatArea({ messages, streamingText, currentQuery, onQueryChange, onSendMessage, onShowMemory, onShowConfig, loading, onShowDetail }) {
 
     const messagesEndRef = useRef(null);
     const textareaRef = useRef(null);
@@ -605,7 +630,7 @@ function ChatArea({ messages, currentQuery, onQueryChange, onSendMessage, onShow
         messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
     };
 
-    useEffect(scrollToBottom, [messages]);
+    useEffect(scrollToBottom, [messages, streamingText]);
 
     const handleKeyPress = (e) => {
         if (e.key === 'Enter' && !e.shiftKey) {
@@ -674,6 +699,13 @@ function ChatArea({ messages, currentQuery, onQueryChange, onSendMessage, onShow
                                 onShowDetail={onShowDetail}
                             />
                         ))}
+                        {streamingText && (
+                            <div className="flex justify-start animate-fade-in">
+                                <div className="bg-slate-50 border border-slate-200 p-4 rounded-2xl rounded-bl-lg max-w-2xl shadow-sm text-slate-800">
+                                    <MarkdownContent content={streamingText} />
+                                </div>
+                            </div>
+                        )}
                         <div ref={messagesEndRef} />
                     </div>
                 )}
@@ -198,7 +198,7 @@ The result should be formatted in **JSON** dictionary and enclosed in **triple b
 """
         
         try:
-            response = await self.provider.generate_response(prompt)
+            response = await self.provider.generate_response(prompt, use_cache = True, priority = PRIORITY_BACKGROUND)
             from utils import split_content_and_json
             content, data = split_content_and_json(response)
             if isinstance(data, dict) and isinstance(data.get("files", None), list) :
@@ -386,21 +386,14 @@ class TaskManager:
         self.working_task = None
         self.next_task_id = 1  # Track next available task ID
         self.timelabel = f"{get_random_label()}"
+        self.pending_updates : Dict[int, asyncio.Task] = {}
+        self.on_update = None  # Called as on_update(task_id) once a background update is applied
     
     def load_config(self, config):
         self.config = config
 
-        provider_config = self.config.get("provider", {})
-        provider_name = provider_config.get("name", None)
-        provider_cls = get_provider(provider_name) 
-        if provider_cls is not None: 
-            self.provider = provider_cls(provider_config)
-            add_log(f"TaskManager is using provider: {provider_name}")
-        else:
-            self.provider = self.client.provider
-            add_log(f"TaskManager is using client's provider.")
-
-        self.file_extractor = FileExtractor(self.provider)
+        self.provider = self.client.router.get_provider("task_update")
+        self.file_extractor = FileExtractor(self.client.router.get_provider("file_extract"))
         self.new_task()
     
     async def save(self) -> None :
@@ -488,15 +481,63 @@ class TaskManager:
             return await working_task.get_dynamic_context(query)
         return ""
         
-    async def update(self, query, response):
+    async def submit_update(self, query, response) -> None :
+        """
+        Update the working task with a turn of the conversation. With 'background_update' (the default)
+        the update is queued and applied after the previous updates of the same task, so the answer
+        does not wait on the extraction and task update LLM calls.
+        """
+        task_id = self.working_task
+        results = list(llm_results.get() or [])
+        prompt_sections = dict(self.client.prompt_sections)
+        if not self.config.get("background_update", True) :
+            await self.update(query, response, task_id, prompt_sections)
+            return
+
+        previous = self.pending_updates.get(task_id)
+        update_task = asyncio.ensure_future(self._run_update(previous, task_id, query, response, results, prompt_sections))
+        self.pending_updates[task_id] = update_task
+        update_task.add_done_callback(lambda done : self._forget_update(task_id, done))
+
+    async def _run_update(self, previous, task_id, query, response, results, prompt_sections) -> None :
+        if previous is not None :
+            await asyncio.gather(previous, return_exceptions = True)
+        # The usage of the turn, to which the calls of the update itself are added
+        llm_results.set(results)
+        try :
+            await self.update(query, response, task_id, prompt_sections)
+        except Exception as e :
+            add_log(f"Error in background update of task {task_id}: {e}", label = "error")
+        if self.on_update is not None :
+            try :
+                self.on_update(task_id)
+            except Exception as e :
+                add_log(f"Error notifying update of task {task_id}: {e}", label = "warning")
+
+    def _forget_update(self, task_id, update_task) -> None :
+        if self.pending_updates.get(task_id) is update_task :
+            del self.pending_updates[task_id]
+
+    def is_updating(self, task_id = None) -> bool :
+        if task_id is None :
+            return len(self.pending_updates) > 0
+        return task_id in self.pending_updates
+
+    async def flush(self) -> None :
+        """Wait until every queued task update is applied"""
+        while len(self.pending_updates) > 0 :
+            await asyncio.gather(*list(self.pending_updates.values()), return_exceptions = True)
+
+    async def update(self, query, response, task_id = None, prompt_sections = None):
         """
         Update target, plan and progress based on the query and response.
         When the target is empty, it should figure out the target at first, and then work on the plan and update the progress.
         """
-        if self.working_task not in self.tasks:
+        task_id = task_id if task_id is not None else self.working_task
+        if task_id not in self.tasks:
             return
 
-        current_task = self.tasks[self.working_task]
+        current_task = self.tasks[task_id]
         
         # Prepare context for analysis
         response_text = "\n".join([msg["content"] for msg in response if isinstance(msg.get("content"), str)])
@@ -559,7 +600,7 @@ Format your response as JSON only, enclosed in triple backticks.""")
         
         try:
             if self.provider:
-                llm_response = await self.provider.generate_response(prompt)
+                llm_response = await self.provider.generate_response(prompt, use_cache = True, priority = PRIORITY_BACKGROUND)
                 add_log(f"Text response for TaskManager update: {llm_response}", print = False)
                 
                 # Extract JSON from response
@@ -613,6 +654,10 @@ Format your response as JSON only, enclosed in triple backticks.""")
             log_record.metadata["update_successful"] = False
             add_log(f"Error updating task: {e}", label="error")
         
+        # Token usage and timings of the LLM calls made in this turn
+        log_record.metadata["llm_usage"] = summarize_llm_results(llm_results.get() or [])
+        log_record.metadata["prompt_sections"] = prompt_sections if prompt_sections is not None else dict(self.client.prompt_sections)
+
         # Add the log record to task logs
         current_task.logs.append(log_record)
         
@@ -623,7 +668,7 @@ Format your response as JSON only, enclosed in triple backticks.""")
             add_log(f"Trimmed task logs to {max_logs} entries")
         
         files_count = len(log_record.files)
-        add_log(f"Task {self.working_task} updated successfully. Files extracted: {files_count}", label = "success")
+        add_log(f"Task {task_id} updated successfully. Files extracted: {files_count}", label = "success")
         await self.save()
 
     
\ No newline at end of file
@@ -6,8 +6,15 @@ import logging, warnings
 from urllib.parse import urlparse, urlunparse
 warnings.filterwarnings("ignore")
 
-def get_datetime() :
-    return datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+DATETIME_FORMATS = {
+    "second" : "%Y/%m/%d %H:%M:%S",
+    "minute" : "%Y/%m/%d %H:%M",
+    "hour" : "%Y/%m/%d %H:00",
+    "day" : "%Y/%m/%d",
+}
+
+def get_datetime(granularity = "second") :
+    return datetime.datetime.now().strftime(DATETIME_FORMATS.get(granularity, DATETIME_FORMATS["second"]))
 
 def get_datetime_stamp() :
     return datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
@@ -15,6 +22,17 @@ def get_datetime_stamp() :
 def get_random_label() :
     return "%s_%s" % (get_datetime_stamp(), "%03d" % random.randint(0, 1000))
 
+def get_common_prefix_length(a, b) -> int :
+    """Length of the common prefix of two strings or byte strings"""
+    low, high = 0, min(len(a), len(b))
+    while low < high :
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle] :
+            low = middle
+        else :
+            high = middle - 1
+    return low
+
 def robust_urljoin(base, path):
     """
     Joins two URLs more robustly, preserving path segments
@@ -162,6 +180,43 @@ def split_content_and_json(text) :
             data = {}
     return content, data
 
+def extract_partial_json_string(text, key) :
+    """
+    Extracts the (possibly incomplete) string value of 'key' from a JSON
+    text that is still being generated, e.g. while streaming a response.
+
+    Returns None if the value has not started yet.
+    """
+    match = re.search(r"[\"']%s[\"']\s*:\s*([\"'])" % re.escape(key), text)
+    if match is None :
+        return None
+    quote_char = match.group(1)
+    escapes = {"n" : "\n", "t" : "\t", "r" : "\r", "b" : "\b", "f" : "\f", "/" : "/", "\\" : "\\", "\"" : "\"", "'" : "'"}
+    chars, i = [], match.end()
+    while i < len(text) :
+        char = text[i]
+        if char == "\\" :
+            if i + 1 >= len(text) :
+                break
+            code = text[i + 1]
+            if code == "u" :
+                if i + 6 > len(text) :
+                    break
+                try :
+                    chars.append(chr(int(text[i + 2 : i + 6], 16)))
+                except ValueError :
+                    pass
+                i += 6
+                continue
+            chars.append(escapes.get(code, code))
+            i += 2
+            continue
+        if char == quote_char :
+            break
+        chars.append(char)
+        i += 1
+    return "".join(chars)
+
 def is_int_convertible(value):
     try:
         # First, try converting to a float to handle cases like "5.0"
@@ -246,6 +301,14 @@ def convert_to_boolean(value):
 def truncate_string(s, num) : 
     return s[: min(len(s), num)]
 
+def estimate_tokens(text) -> int :
+    """
+    Fast local estimate of the number of tokens of a text: about 4 characters per token
+    for ASCII text, and a token per character for other scripts such as CJK.
+    """
+    ascii_num = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_num / 4) + (len(text) - ascii_num)
+
 def clean_string(s):
     s = s.lower()
     s = re.sub(r'[^\w\s]', '', s)